@@ -0,0 +1,406 @@
+import argparse
+import datetime
+import glob
+import json
+import math
+import os
+import platform
+import random
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+import pandas as pd
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, 'scripts'))
+
+import synthetic_data as data
+
+'''
+Times the core functions of the scripts on seeded synthetic inputs at growing
+sizes and appends the timings to a JSON history. Every benchmark builds its inputs
+for a size outside of the timed part, the best of -repeat runs is recorded.
+
+The growth exponent between two sizes (log of the time ratio over log of the size
+ratio) is printed for every benchmark, about 1 is linear and about 2 is quadratic,
+so a per-row lookup that scans the whole table shows up as a growing exponent.
+Every run is compared to the last run in the history with the same sizes.
+
+Benchmarks whose inputs do not grow with the size of a table (e.g. one OptiType
+call per sample) are scaled by the number of samples instead. Benchmarks with a
+known quadratic part or a high cost per row are run up to max_rows, which takes the
+place of the larger sizes, so a full run stays short.
+
+Example Run:
+python3 benchmarks/run_benchmarks.py -scales 10,100,1000,10000,100000 -history benchmarks/history.json
+python3 benchmarks/run_benchmarks.py -benchmarks generate_reviews_files,color_peptides51mer -repeat 5
+'''
+
+
+# ---- PARSE ARGUMENTS -------------------------------------------------------
+# Parses command line arguments
+# Enables user help
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the scripts on synthetic data')
+
+    parser.add_argument('-scales', default='10,100,1000,10000,100000',
+                        help='Comma separated numbers of rows to run every benchmark at (default: 10,100,1000,10000,100000)')
+    parser.add_argument('-benchmarks',
+                        help='Comma separated benchmarks to run (default: all), see -list')
+    parser.add_argument('-list', action='store_true',
+                        help='List the benchmarks and exit')
+    parser.add_argument('-repeat', type=int, default=3,
+                        help='The number of timed runs per benchmark and size, the fastest is recorded (default: 3)')
+    parser.add_argument('-seed', type=int, default=0,
+                        help='The seed of the synthetic data (default: 0)')
+    parser.add_argument('-history', default=os.path.join(REPO, 'benchmarks', 'history.json'),
+                        help='The JSON history the run is appended to (default: benchmarks/history.json)')
+    parser.add_argument('-label',
+                        help='A label stored with the run, e.g. the change being measured')
+
+    return(parser.parse_args())
+
+
+@contextmanager
+def working_directory(path):
+    # Some scripts write to and read from the current directory
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+@contextmanager
+def script_arguments(argv):
+    # For the scripts that parse sys.argv themselves
+    previous = sys.argv
+    sys.argv = argv
+    try:
+        yield
+    finally:
+        sys.argv = previous
+
+
+# ---- BENCHMARKS ------------------------------------------------------------
+# Each benchmark writes its inputs for a number of rows into a directory and returns
+# the function that is timed.
+
+def bench_peptide_ids(directory, rows, seed):
+    import peptide_ids
+    ids = pd.Series(['MT.' + variant['index'] for variant in data.make_variants(rows, seed)])
+
+    def run():
+        records = peptide_ids.parse_ids(ids)
+        peptide_ids.variant_keys(records)
+        peptide_ids.transcript_keys(records)
+        peptide_ids.position_keys(records)
+    return run
+
+def bench_make_unique(directory, rows, seed):
+    import peptide_ids
+    genes = pd.Series([variant['gene'] for variant in data.make_variants(rows, seed)])
+    return lambda: peptide_ids.make_unique(genes, number_first=True)
+
+def bench_peptide_metrics(directory, rows, seed):
+    import peptide_metrics
+    sequences = pd.Series([variant['sequence'] for variant in data.make_variants(rows, seed)])
+
+    def run():
+        peptide_metrics.molecular_weights(sequences)
+        peptide_metrics.manufacturability_metrics(sequences)
+    return run
+
+def bench_fallback_keys(directory, rows, seed):
+    import epitope_locator
+    variants = data.make_variants(rows, seed)
+    sequences = [variant['sequence'] for variant in variants]
+    # half of the keys do not match and are joined by sequence
+    keys = [variant['index'] if number % 2 else 'unmatched' for number, variant in enumerate(variants)]
+    epitope_keys = [variant['index'] for variant in variants]
+    epitopes = [variant['sequence'][20:29] for variant in variants]
+    return lambda: epitope_locator.fallback_keys(keys, sequences, epitope_keys, epitopes)
+
+def bench_read_aggregated(directory, rows, seed):
+    import pvacseq_io
+    path = os.path.join(directory, 'classI.aggregated.tsv')
+    data.write_aggregated(path, data.make_variants(rows, seed), 'I', seed)
+    return lambda: pvacseq_io.read_pvacseq_table(path, pvacseq_io.AGGREGATED_COLUMNS)
+
+def bench_top_epitopes(directory, rows, seed):
+    import pvacseq_io
+    path = os.path.join(directory, 'classI.all_epitopes.tsv')
+    data.write_all_epitopes(path, data.make_variants(max(1, rows // 10), seed), 10, 'I', seed)
+    return lambda: pvacseq_io.top_epitopes(path, pvacseq_io.ALL_EPITOPES_COLUMNS, 3, chunksize=max(1000, rows // 4))
+
+def review_inputs(directory, rows, seed):
+    variants = data.make_variants(rows, seed)
+    paths = {name: os.path.join(directory, name) for name in
+             ['itb.tsv', 'manufacturability.tsv', 'classI.tsv', 'classII.tsv', 'variants.tsv']}
+    data.write_itb_review(paths['itb.tsv'], variants, seed)
+    data.write_manufacturability(paths['manufacturability.tsv'], variants)
+    data.write_aggregated(paths['classI.tsv'], variants, 'I', seed)
+    data.write_aggregated(paths['classII.tsv'], variants, 'II', seed + 1)
+    data.write_variants(paths['variants.tsv'], variants, seed)
+    return paths
+
+def review_argv(directory, paths):
+    return ['-reviewed_candidates', paths['itb.tsv'], '-peptides', paths['manufacturability.tsv'],
+            '-variants', paths['variants.tsv'], '-classI', paths['classI.tsv'], '-classII', paths['classII.tsv'],
+            '-samp', 'SYN', '-o', directory]
+
+def bench_fill_variant_called(directory, rows, seed):
+    import generate_reviews_files
+    paths = review_inputs(directory, rows, seed)
+    candidates = pd.read_csv(paths['itb.tsv'], sep="\t")
+    variants = pd.read_csv(paths['variants.tsv'], sep="\t")
+    return lambda: generate_reviews_files.fill_variant_called_column(candidates.copy(), variants)
+
+def bench_generate_reviews_files(directory, rows, seed):
+    import generate_reviews_files
+    args = generate_reviews_files.parse_arguments(review_argv(directory, review_inputs(directory, rows, seed)))
+    return lambda: generate_reviews_files.main(args)
+
+def bench_color_peptides51mer(directory, rows, seed):
+    import generate_reviews_files
+    import color_peptides51mer
+    paths = review_inputs(directory, rows, seed)
+    generate_reviews_files.main(generate_reviews_files.parse_arguments(review_argv(directory, paths)))
+    args = color_peptides51mer.parse_arguments(['-peptides', os.path.join(directory, 'SYN_Peptides_51-mer.xlsx'),
+                                                '-classI', paths['classI.tsv'], '-classII', paths['classII.tsv'],
+                                                '-samp', 'SYN', '-format', 'both', '-o', directory + '/'])
+    return lambda: color_peptides51mer.main(args)
+
+def bench_bold_classII(directory, rows, seed):
+    # bold_classII.py runs at import, it is run as a script. It reads the Peptides 51-mer
+    # before the class I and class II columns are added, so only those columns are written.
+    import review_io
+    paths = review_inputs(directory, rows, seed)
+    peptides = pd.read_csv(paths['manufacturability.tsv'], sep="\t")
+    peptides_51mer = pd.DataFrame({'ID': peptides['id'], 'CANDIDATE NEOANTIGEN': 'SYN.' + peptides['id'],
+                                   'CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE WITH FLANKING RESIDUES': peptides['peptide_sequence'],
+                                   'RESTRICTING HLA ALLELE': ' ', 'CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE MW (CLIENT)': 5000.0,
+                                   'Comments': ' '})
+    peptides_file = os.path.join(directory, 'SYN_Peptides_51-mer.xlsx')
+    review_io.write_review_workbook(peptides_51mer, peptides_file)
+    review_io.write_sidecar(peptides_51mer, peptides_file)
+    argv = ['bold_classII.py', '-p', peptides_file, '-classI', paths['classI.tsv'],
+            '-classII', paths['classII.tsv'], '-o', os.path.join(directory, 'bold.html')]
+
+    def run():
+        with script_arguments(argv):
+            runpy.run_path(os.path.join(REPO, 'scripts', 'bold_classII.py'), run_name='__main__')
+    return run
+
+def modify_inputs(directory, rows, seed):
+    path = os.path.join(directory, 'peptides.csv')
+    variants = data.make_variants(rows, seed)
+    pd.DataFrame({'Name': [variant['gene'] for variant in variants],
+                  'Sequence': [variant['sequence'][10:35] for variant in variants]}).to_csv(path, index=False)
+    return path
+
+def bench_modify_peptides(directory, rows, seed):
+    import modify_peptides
+    argv = ['modify_peptides.py', '-n', '2', '-m', modify_inputs(directory, rows, seed), '-samp', 'SYN', '-WD', directory]
+
+    def run():
+        with working_directory(directory), script_arguments(argv):
+            modify_peptides.main()
+    return run
+
+def bench_pvacbind_results(directory, rows, seed):
+    # pVACbind results for every tested sub-peptide of the modified peptides
+    import modify_peptides
+    import pvacbind_results
+    rng = random.Random(seed)
+    argv = ['modify_peptides.py', '-n', '2', '-m', modify_inputs(directory, rows, seed), '-samp', 'SYN', '-WD', directory]
+    with working_directory(directory), script_arguments(argv):
+        modify_peptides.main()
+
+    for fasta in glob.glob(os.path.join(directory, '*', 'pvacbind_inputs', '*-mer-test.fa')):
+        with open(fasta) as sequences:
+            names = [line[1:].strip() for line in sequences if line.startswith('>')]
+        terminus = fasta.split(os.sep)[-3]
+        length = os.path.basename(fasta).split('-')[0]
+        results = os.path.join(directory, terminus, 'pvacbind_results', f"{length}-mer-test", 'MHC_Class_I', 'SYN.all_epitopes.tsv')
+        data.ensure_directory(results)
+        pd.DataFrame({'Mutation': names, 'HLA Allele': [rng.choice(data.CLASS_I_ALLELES) for _ in names],
+                      'Epitope Seq': 'A' * int(length), 'Median IC50 Score': [rng.uniform(5, 30000) for _ in names],
+                      'Median Percentile': [rng.uniform(0.01, 50) for _ in names]}).to_csv(results, sep="\t", index=False)
+
+    output = os.path.join(directory, 'modified_peptides.ranked.tsv')
+    return lambda: pvacbind_results.aggregate_results(directory, ['n-term', 'c-term'], [8, 9, 10, 11], output)
+
+def bench_get_FDA_thresholds(directory, rows, seed):
+    # The FDA quality threshold table is read relative to the repository when not run in Docker
+    import get_FDA_thresholds
+    working_base = os.path.join(directory, 'gcp_immuno')
+    data.write_working_base(working_base, rows, seed)
+    args = get_FDA_thresholds.parse_arguments(['-WB', working_base])
+
+    def run():
+        with working_directory(REPO):
+            get_FDA_thresholds.main(args)
+    return run
+
+def bench_get_neoantigen_qc(directory, rows, seed):
+    import get_neoantigen_qc
+    working_base = os.path.join(directory, 'gcp_immuno')
+    yaml = data.write_working_base(working_base, rows, seed)
+    args = get_neoantigen_qc.parse_arguments(['-WB', working_base, '--yaml', yaml])
+    return lambda: get_neoantigen_qc.main(args)
+
+def bench_hla_comparison(directory, rows, seed):
+    # OptiType and PHLAT calls of rows samples, one normal/tumor pair each
+    import hla_comparison
+    samples = []
+    for number in range(rows):
+        files = {}
+        for sample_type in ['normal', 'tumor']:
+            files[('optitype', sample_type)] = os.path.join(directory, f"sample{number}", f"optitype_{sample_type}_result.tsv")
+            files[('phlat', sample_type)] = os.path.join(directory, f"sample{number}", f"phlat_{sample_type}_HLA.sum")
+            data.write_optitype(files[('optitype', sample_type)], seed + number)
+            data.write_phlat(files[('phlat', sample_type)], seed + number)
+        samples.append(files)
+
+    def run():
+        calls = []
+        for files in samples:
+            for sample_type in ['normal', 'tumor']:
+                calls.append(hla_comparison.process_optitype(files[('optitype', sample_type)], sample_type))
+                calls.append(hla_comparison.process_phlat(files[('phlat', sample_type)], sample_type))
+        hla_comparison.sort_hla_pairs(pd.concat(calls, ignore_index=True))
+    return run
+
+
+# name, function, largest number of rows it is run at (None for no limit)
+BENCHMARKS = [
+    ('peptide_ids', bench_peptide_ids, None),
+    ('make_unique', bench_make_unique, None),
+    ('peptide_metrics', bench_peptide_metrics, None),
+    ('fallback_keys', bench_fallback_keys, None),
+    ('read_aggregated', bench_read_aggregated, None),
+    ('top_epitopes', bench_top_epitopes, None),
+    ('fill_variant_called', bench_fill_variant_called, None),
+    ('generate_reviews_files', bench_generate_reviews_files, None),
+    ('color_peptides51mer', bench_color_peptides51mer, None),
+    ('bold_classII', bench_bold_classII, None),
+    ('modify_peptides', bench_modify_peptides, 10000),
+    ('pvacbind_results', bench_pvacbind_results, 10000),
+    ('get_FDA_thresholds', bench_get_FDA_thresholds, None),
+    ('get_neoantigen_qc', bench_get_neoantigen_qc, None),
+    # four pandas reads per sample, scaled by samples
+    ('hla_comparison', bench_hla_comparison, 100),
+]
+
+
+# ---- RUN -------------------------------------------------------------------
+def time_benchmark(function, rows, seed, repeat):
+    # Best wall time of repeat runs, the inputs are written once for all runs
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            run = function(directory, rows, seed)
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def benchmark_scales(scales, max_rows=None):
+    # The sizes up to max_rows, max_rows itself takes the place of the larger sizes
+    if max_rows is None or max(scales) <= max_rows:
+        return scales
+    return sorted(set(rows for rows in scales if rows < max_rows) | {max_rows})
+
+def growth_exponents(timings):
+    # log(t2 / t1) / log(n2 / n1) between every two consecutive sizes
+    sizes = sorted(int(rows) for rows in timings)
+    return [math.log(timings[str(large)] / timings[str(small)]) / math.log(large / small)
+            if timings[str(small)] > 0 and timings[str(large)] > 0 else float('nan')
+            for small, large in zip(sizes, sizes[1:])]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', '-C', REPO, 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def read_history(path):
+    if not os.path.isfile(path):
+        return []
+    with open(path) as history:
+        return json.load(history)
+
+def write_history(history, path):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(history, file, indent=2)
+    os.replace(path + '.tmp', path)
+
+def print_report(run, previous=None):
+    # One line per benchmark: the time at every size, the growth exponents and the change against the previous run
+    print(f"{'benchmark':<24}{'rows':>10}{'seconds':>12}{'growth':>9}{'vs last':>9}")
+    for name, timings in run['results'].items():
+        exponents = [None] + growth_exponents(timings)
+        for (rows, seconds), exponent in zip(sorted(timings.items(), key=lambda item: int(item[0])), exponents):
+            last = previous['results'].get(name, {}).get(rows) if previous else None
+            change = f"{seconds / last:.2f}x" if last else ''
+            growth = '' if exponent is None else f"{exponent:.2f}"
+            print(f"{name:<24}{int(rows):>10}{seconds:>12.4f}{growth:>9}{change:>9}")
+
+        if len(exponents) > 1 and exponents[-1] is not None and exponents[-1] > 1.5:
+            print(f"{'':<24}grows faster than linear (exponent {exponents[-1]:.2f} at the largest size)")
+
+    for name, failure in run['failures'].items():
+        print(f"{name:<24}failed at {failure['rows']} rows: {failure['error']}")
+
+
+def main():
+    args = parse_arguments()
+
+    if args.list:
+        for name, _, max_rows in BENCHMARKS:
+            print(name, '' if max_rows is None else f"(up to {max_rows} rows)")
+        return
+
+    scales = sorted(int(rows) for rows in args.scales.split(','))
+    selected = args.benchmarks.split(',') if args.benchmarks else [name for name, _, _ in BENCHMARKS]
+    unknown = set(selected) - set(name for name, _, _ in BENCHMARKS)
+    if unknown:
+        print("Unknown benchmarks:", ', '.join(sorted(unknown)))
+        sys.exit(1)
+
+    run = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'label': args.label,
+           'python': platform.python_version(), 'pandas': pd.__version__, 'seed': args.seed, 'repeat': args.repeat,
+           'scales': scales, 'results': {}, 'failures': {}}
+
+    for name, function, max_rows in BENCHMARKS:
+        if name not in selected:
+            continue
+        run['results'][name] = {}
+        for rows in benchmark_scales(scales, max_rows):
+            try:
+                seconds = time_benchmark(function, rows, args.seed, args.repeat)
+            except (Exception, SystemExit) as e:
+                # a broken script ends its own benchmark, the larger sizes are not run
+                print(f"{name} {rows} rows: failed, {e!r}", file=sys.stderr)
+                run['failures'][name] = {'rows': rows, 'error': repr(e)}
+                break
+            run['results'][name][str(rows)] = seconds
+            print(f"{name} {rows} rows: {seconds:.4f}s", file=sys.stderr)
+
+    history = read_history(args.history)
+    previous = next((earlier for earlier in reversed(history) if earlier['scales'] == scales), None)
+    print_report(run, previous)
+
+    history.append(run)
+    write_history(history, args.history)
+    print("Appended the run to", args.history)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import os
+import random
+import pandas as pd
+
+'''
+Seeded synthetic inputs for the benchmarks, one writer per file format the scripts
+read. The same seed and size always give the same files. The pVACseq tables, the
+51mer manufacturability tsv, the ITB review tsv and the variants tsv are written
+from one set of variants so they join the way real pipeline outputs do.
+
+Example:
+variants = make_variants(1000, seed=0)
+write_manufacturability(path, variants)
+write_aggregated(path, variants, 'I', seed=0)
+'''
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+CLASS_I_ALLELES = ['HLA-A*02:01', 'HLA-A*24:02', 'HLA-B*07:02', 'HLA-B*35:02', 'HLA-C*04:01', 'HLA-C*07:02']
+CLASS_II_ALLELES = ['DRB1*11:01', 'DRB1*04:05', 'DQA1*05:05-DQB1*03:01', 'DPA1*01:03-DPB1*04:01']
+
+# The metrics of the FDA aligned tables that get_FDA_thresholds evaluates
+FDA_ALIGNED_METRICS = {'PCT_USABLE_BASES_ON_TARGET': (0.1, 0.6), 'PCT_EXC_OFF_TARGET': (0.2, 0.8),
+                       'PERCENT_DUPLICATION': (5, 60), 'MEAN_TARGET_COVERAGE': (50, 400),
+                       'PCT_TARGET_BASES_20X': (0.8, 1.0), 'PCT_READS_ALIGNED_IN_PAIRS': (0.9, 1.0),
+                       'MEAN_INSERT_SIZE': (100, 350), 'PF_MISMATCH_RATE_1': (0.001, 0.01),
+                       'PF_MISMATCH_RATE_2': (0.001, 0.02)}
+
+PHLAT_LOCI = ['HLA_A', 'HLA_B', 'HLA_C', 'HLA_DQA1', 'HLA_DQB1', 'HLA_DRB1']
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice(AMINO_ACIDS) for _ in range(length))
+
+def ensure_directory(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+# ---- VARIANTS --------------------------------------------------------------
+def make_variants(rows, seed=0):
+    # One record per candidate variant with its 51mer, pVACseq Index and genomic position
+    rng = random.Random(seed)
+    genes = [f"GENE{i}" for i in range(max(3, rows // 2))]
+    variants = []
+
+    for number in range(rows):
+        gene = rng.choice(genes)
+        transcript = f"ENST{rng.randint(10**10, 10**11):011d}"
+        version = rng.randint(1, 9)
+        position = rng.randint(10, 900)
+        ref = rng.choice(AMINO_ACIDS)
+        alt = rng.choice(AMINO_ACIDS)
+        variant_type = rng.choice(['missense', 'missense', 'missense', 'FS', 'inframe_ins', 'inframe_del'])
+
+        if variant_type == 'missense':
+            change, aa_change = f"{position}{ref}/{alt}", f"{ref}{position}{alt}"
+        elif variant_type == 'FS':
+            change, aa_change = f"{position}-{position + 5}CGCGCA/C", f"FS{position}"
+        elif variant_type == 'inframe_ins':
+            change, aa_change = f"{position}{ref}/{ref}{alt}", f"{ref}{position}{ref}{alt}"
+        else:
+            change, aa_change = f"{position}-{position + 3}{ref}{alt}GV/R", f"{ref}{alt}GV{position}-{position + 3}R"
+
+        chromosome = f"chr{rng.randint(1, 22)}"
+        genomic_position = rng.randint(1000, 10**8)
+        index = f"{number}.{gene}.{transcript}.{version}.{variant_type}.{change}"
+
+        variants.append({'number': number, 'gene': gene, 'transcript': f"{transcript}.{version}",
+                         'variant_type': variant_type, 'aa_change': aa_change, 'index': index,
+                         'chromosome': chromosome, 'position': genomic_position,
+                         'ID': f"{chromosome}-{genomic_position - 1}-{genomic_position}-A-T",
+                         'sequence': random_sequence(rng, 51)})
+    return variants
+
+
+# ---- PVACSEQ ---------------------------------------------------------------
+def write_manufacturability(path, variants):
+    # annotated_filtered.vcf-pass-51mer.fa.manufacturability.tsv
+    ensure_directory(path)
+    pd.DataFrame({
+        'id': ['MT.' + variant['index'] for variant in variants],
+        'peptide_sequence': [variant['sequence'] for variant in variants],
+        'cterm_7mer_gravy_score': 0.1, 'max_7mer_gravy_score': 1.0,
+        'difficult_n_terminal_residue': False, 'c_terminal_cysteine': False, 'c_terminal_proline': False,
+        'cysteine_count': 0, 'n_terminal_asparagine': False, 'asparagine_proline_bond_count': 0,
+    }).to_csv(path, sep="\t", index=False)
+
+def write_aggregated(path, variants, hla_class='I', seed=0):
+    # all_epitopes.aggregated.tsv, one row per variant with a best peptide taken from its 51mer
+    rng = random.Random(seed)
+    length = 9 if hla_class == 'I' else 15
+    alleles = CLASS_I_ALLELES if hla_class == 'I' else CLASS_II_ALLELES
+    rows = []
+
+    for variant in variants:
+        start = rng.randint(0, 51 - length)
+        rows.append({'ID': variant['ID'], 'Index': variant['index'], 'Gene': variant['gene'],
+                     'AA Change': variant['aa_change'], 'Num Passing Transcripts': 1,
+                     'Best Peptide': variant['sequence'][start:start + length], 'Best Transcript': variant['transcript'],
+                     'TSL': 1, 'Allele': rng.choice(alleles), 'Pos': rng.choice(['5', '1', '3,5', 'NA']),
+                     'Prob Pos': 'None', 'Num Included Peptides': 1, 'Num Passing Peptides': 1,
+                     'IC50 MT': rng.uniform(5, 3000), 'IC50 WT': rng.uniform(5, 30000),
+                     '%ile MT': rng.uniform(0.01, 5), '%ile WT': rng.uniform(0.01, 50),
+                     'RNA Expr': rng.uniform(0, 100), 'RNA VAF': rng.uniform(0, 1), 'Allele Expr': rng.uniform(0, 100),
+                     'RNA Depth': rng.randint(0, 300), 'DNA VAF': rng.uniform(0, 1), 'Tier': 'Pass',
+                     'Ref Match': False, 'Evaluation': 'Pending'})
+    ensure_directory(path)
+    pd.DataFrame(rows).to_csv(path, sep="\t", index=False)
+
+def write_all_epitopes(path, variants, per_variant=10, hla_class='I', seed=0):
+    # all_epitopes.tsv, per_variant epitopes of every variant
+    rng = random.Random(seed)
+    alleles = CLASS_I_ALLELES if hla_class == 'I' else CLASS_II_ALLELES
+    rows = []
+
+    for variant in variants:
+        for _ in range(per_variant):
+            length = rng.randint(8, 11) if hla_class == 'I' else 15
+            start = rng.randint(0, 51 - length)
+            rows.append({'Chromosome': variant['chromosome'], 'Start': variant['position'] - 1, 'Stop': variant['position'],
+                         'Reference': 'A', 'Variant': 'T', 'Transcript': variant['transcript'],
+                         'Variant Type': variant['variant_type'], 'Mutation': variant['aa_change'],
+                         'Protein Position': variant['aa_change'].strip(AMINO_ACIDS + '*/'), 'Gene Name': variant['gene'],
+                         'HLA Allele': rng.choice(alleles), 'Peptide Length': length,
+                         'Mutation Position': rng.choice(['5', '1', '3-4', 'NA']),
+                         'MT Epitope Seq': variant['sequence'][start:start + length], 'WT Epitope Seq': 'NA',
+                         'Median MT IC50 Score': rng.uniform(5, 30000), 'Median WT IC50 Score': rng.uniform(5, 30000),
+                         'Median MT Percentile': rng.uniform(0.01, 50), 'Median WT Percentile': rng.uniform(0.01, 50),
+                         'Index': variant['index']})
+    ensure_directory(path)
+    pd.DataFrame(rows).to_csv(path, sep="\t", index=False)
+
+def write_itb_review(path, variants, seed=0):
+    # The ITB Reviewed Candidates tsv downloaded from pVACview
+    rng = random.Random(seed)
+    rows = []
+
+    for variant in variants:
+        start = rng.randint(0, 42)
+        rows.append({'ID': variant['ID'], 'Index': variant['index'], 'Gene': variant['gene'],
+                     'AA Change': variant['aa_change'], 'Best Transcript': variant['transcript'], 'Tier': 'Pass',
+                     'Evaluation': rng.choice(['Accept', 'Accept', 'Review', 'Reject', 'Pending']),
+                     'Best Peptide': variant['sequence'][start:start + 9], 'Allele': rng.choice(CLASS_I_ALLELES),
+                     'Pos': '5', 'IC50 MT': rng.uniform(5, 3000), '%ile MT': rng.uniform(0.01, 5), 'Comments': 'ok'})
+    ensure_directory(path)
+    pd.DataFrame(rows).to_csv(path, sep="\t", index=False)
+
+def write_variants(path, variants, seed=0):
+    # variants.final.annotated.tsv
+    rng = random.Random(seed)
+    ensure_directory(path)
+    pd.DataFrame({'CHROM': [variant['chromosome'] for variant in variants],
+                  'POS': [variant['position'] for variant in variants],
+                  'REF': 'A', 'ALT': 'T',
+                  'VALIDATED': [rng.choice([True, False]) for _ in variants]}).to_csv(path, sep="\t", index=False)
+
+
+# ---- QC --------------------------------------------------------------------
+def write_fda_aligned_table(path, rows, rna=False, seed=0):
+    # aligned_*_table2.csv / table3.csv, Criteria,Value without a header. rows - 1 filler metrics
+    # are added to the ones get_FDA_thresholds evaluates.
+    rng = random.Random(seed)
+    mapped = "Total mapped reads (%)" if rna else "Total Mapped Reads (%)"
+    lines = [f"{mapped},{rng.uniform(80, 100):.2f} (%)"]
+    lines += [f"{metric},{rng.uniform(low, high):.4f}" for metric, (low, high) in FDA_ALIGNED_METRICS.items()]
+    lines += [f"OTHER_METRIC_{number},{rng.uniform(0, 1):.4f}" for number in range(max(0, rows - len(lines)))]
+    ensure_directory(path)
+    with open(path, 'w') as table:
+        table.write('\n'.join(lines) + '\n')
+
+def write_fda_unaligned_table(path, rows, lanes=4, seed=0):
+    # unaligned_*_table1.csv, one column per lane and a Total Number of Reads row
+    rng = random.Random(seed)
+    table = {'Sample Name': ['Total Number of Reads'] + [f"Other Metric {number}" for number in range(max(0, rows - 1))]}
+    for lane in range(lanes):
+        table[f"lane-{lane + 1}"] = [rng.randint(5 * 10**7, 10**8) for _ in range(max(1, rows))]
+    ensure_directory(path)
+    pd.DataFrame(table).to_csv(path, index=False)
+
+def write_verifybamid(path, rows, seed=0):
+    # VerifyBamID .selfSM, one row per read group
+    rng = random.Random(seed)
+    lines = ["#SEQ_ID\tRG\tCHIP_ID\t#SNPS\t#READS\tAVG_DP\tFREEMIX\tFREELK1\tFREELK0\tFREE_RH\tFREE_RA\tCHIPMIX\tCHIPLK1\tCHIPLK0\tCHIP_RH\tCHIP_RA\tDPREF\tRDPHET\tRDPALT"]
+    lines += [f"sample\tRG{number}\tNA\t{rng.randint(1000, 5000)}\t{rng.randint(10**5, 10**6)}\t{rng.uniform(10, 100):.2f}\t"
+              f"{rng.uniform(0, 0.1):.5f}\t0\t0\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA" for number in range(max(1, rows))]
+    ensure_directory(path)
+    with open(path, 'w') as selfsm:
+        selfsm.write('\n'.join(lines) + '\n')
+
+def write_somalier_pairs(path, rows, seed=0):
+    # concordance.somalier.pairs.tsv
+    rng = random.Random(seed)
+    lines = ["#sample_a\tsample_b\trelatedness\tibs0\tibs2\thom_concordance\thets_a\thets_b\thets_ab\tshared_hets\thom_alts_a\thom_alts_b\tshared_hom_alts\tn\tx_ibs0\tx_ibs2\texpected_relatedness"]
+    lines += [f"normal{number}\ttumor{number}\t{rng.uniform(0.8, 1):.3f}\t0\t{rng.randint(1000, 5000)}\t0.99\t100\t100\t100\t100\t50\t50\t50\t5000\t0\t100\t-1"
+              for number in range(max(1, rows))]
+    ensure_directory(path)
+    with open(path, 'w') as pairs:
+        pairs.write('\n'.join(lines) + '\n')
+
+def write_aligned_metrics(path, rows, seed=0):
+    # table_metrics/*_aligned_metrics.txt read by get_neoantigen_qc
+    rng = random.Random(seed)
+    lines = [f"Unique Mapped Reads\t{rng.randint(3 * 10**7, 2 * 10**8)}",
+             f"Mapped Read Duplication\t{rng.randint(10**6, 10**7)}\t{rng.uniform(5, 80):.2f} (%)"]
+    lines += [f"Other Metric {number}\t{rng.randint(0, 10**6)}" for number in range(max(0, rows - len(lines)))]
+    ensure_directory(path)
+    with open(path, 'w') as metrics:
+        metrics.write('\n'.join(lines) + '\n')
+
+def write_rna_metrics(path, rows, seed=0):
+    # Picard CollectRnaSeqMetrics output with a coverage histogram of rows lines
+    rng = random.Random(seed)
+    keys = ['PF_BASES', 'PF_ALIGNED_BASES', 'RIBOSOMAL_BASES', 'CODING_BASES', 'UTR_BASES', 'INTRONIC_BASES',
+            'INTERGENIC_BASES', 'PCT_RIBOSOMAL_BASES', 'PCT_CODING_BASES', 'PCT_UTR_BASES', 'PCT_INTRONIC_BASES',
+            'PCT_INTERGENIC_BASES', 'PCT_MRNA_BASES', 'MEDIAN_CV_COVERAGE', 'MEDIAN_5PRIME_BIAS', 'MEDIAN_3PRIME_BIAS']
+    coding, utr = rng.uniform(0.3, 0.6), rng.uniform(0.1, 0.3)
+    values = [10**10, 9 * 10**9, 0, 4 * 10**9, 2 * 10**9, 10**9, 10**9, 0, f"{coding:.6f}", f"{utr:.6f}",
+              0.1, 0.1, f"{coding + utr:.6f}", 0.5, 0.4, 0.6]
+    lines = ["## htsjdk.samtools.metrics.StringHeader", "# CollectRnaSeqMetrics", "",
+             "## METRICS CLASS\tpicard.analysis.RnaSeqMetrics", '\t'.join(keys), '\t'.join(str(value) for value in values),
+             "", "## HISTOGRAM\tjava.lang.Integer", "normalized_position\tAll_Reads.normalized_coverage"]
+    lines += [f"{number}\t{rng.uniform(0, 2):.6f}" for number in range(max(1, rows))]
+    ensure_directory(path)
+    with open(path, 'w') as metrics:
+        metrics.write('\n'.join(lines) + '\n')
+
+def write_strandness_check(path, rows):
+    # trimmed_read_1strandness_check.txt, the last line is the verdict
+    lines = [f"Checking read {number}" for number in range(max(0, rows - 1))]
+    lines.append("Data is likely RF/fr-firststrand")
+    ensure_directory(path)
+    with open(path, 'w') as check:
+        check.write('\n'.join(lines) + '\n')
+
+
+# ---- HLA TYPING ------------------------------------------------------------
+def random_allele(rng, locus):
+    return f"{locus}*{rng.randint(1, 99):02d}:{rng.randint(1, 99):02d}"
+
+def write_optitype(path, seed=0):
+    # optitype_*_result.tsv, one row with two alleles of A, B and C
+    rng = random.Random(seed)
+    alleles = [random_allele(rng, locus) for locus in ['A', 'A', 'B', 'B', 'C', 'C']]
+    ensure_directory(path)
+    with open(path, 'w') as result:
+        result.write("\tA1\tA2\tB1\tB2\tC1\tC2\tReads\tObjective\n")
+        result.write("0\t" + '\t'.join(alleles) + f"\t{rng.randint(1000, 5000)}\t{rng.uniform(1000, 5000):.3f}\n")
+
+def write_phlat(path, seed=0):
+    # phlat_*_HLA.sum, one row per locus
+    rng = random.Random(seed)
+    ensure_directory(path)
+    with open(path, 'w') as result:
+        result.write("Locus\tAllele1\tAllele2\tRank\tp-value1\tp-value2\n")
+        for locus in PHLAT_LOCI:
+            name = locus.split('_')[1]
+            result.write(f"{locus}\t{random_allele(rng, name)}:01\t{random_allele(rng, name)}:01\t1\t0.01\t0.02\n")
+
+
+# ---- WORKING BASE ----------------------------------------------------------
+def write_working_base(working_base, rows, seed=0, final_results='final_results'):
+    # The QC and HLA typing files below a gcp_immuno folder at the paths the QC scripts look for them
+    qc = f"{working_base}/{final_results}/qc"
+    fda = f"{qc}/fda_metrics"
+
+    write_fda_aligned_table(f"{fda}/aligned_normal_dna/aligned_normal_dna_table2.csv", rows, seed=seed)
+    write_fda_aligned_table(f"{fda}/aligned_tumor_dna/aligned_tumor_dna_table2.csv", rows, seed=seed + 1)
+    write_fda_aligned_table(f"{fda}/aligned_tumor_rna/aligned_tumor_rna_table3.csv", rows, rna=True, seed=seed + 2)
+    for number, sample in enumerate(['normal_dna', 'tumor_dna', 'tumor_rna']):
+        write_fda_unaligned_table(f"{fda}/unaligned_{sample}/unaligned_{sample}_table1.csv", rows, seed=seed + number)
+        write_aligned_metrics(f"{fda}/aligned_{sample}/table_metrics/{sample}_aligned_metrics.txt", rows, seed=seed + number)
+
+    write_somalier_pairs(f"{qc}/concordance/concordance.somalier.pairs.tsv", rows, seed=seed)
+    write_verifybamid(f"{qc}/normal_dna/normal.VerifyBamId.selfSM", rows, seed=seed)
+    write_verifybamid(f"{qc}/tumor_dna/tumor.VerifyBamId.selfSM", rows, seed=seed + 1)
+    write_rna_metrics(f"{qc}/tumor_rna/rna_metrics.txt", rows, seed=seed)
+    write_strandness_check(f"{qc}/tumor_rna/trimmed_read_1strandness_check.txt", rows)
+
+    hla_typing = f"{working_base}/{final_results}/hla_typing"
+    for number, sample in enumerate(['normal', 'tumor']):
+        write_optitype(f"{hla_typing}/optitype_{sample}_result.tsv", seed=seed + number)
+        write_phlat(f"{hla_typing}/phlat_{sample}_HLA.sum", seed=seed + number)
+
+    write_variants(f"{working_base}/{final_results}/variants.final.annotated.tsv", make_variants(rows, seed), seed)
+
+    yaml = f"{working_base}/yamls/pipeline.yaml"
+    ensure_directory(yaml)
+    with open(yaml, 'w') as pipeline:
+        pipeline.write("sample_name: synthetic\nstrand: first\n")
+
+    os.makedirs(f"{working_base}/../manual_review", exist_ok=True)
+    return yaml
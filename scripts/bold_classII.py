@@ -4,6 +4,11 @@ import pandas as pd
 import sys
 import re
 from bs4 import BeautifulSoup
+from record_index import RecordIndex
+from epitope_locator import EpitopeLocator, match_intervals, fallback_keys
+from review_io import read_peptides_table
+from pvacseq_io import read_pvacseq_table
+from peptide_ids import parse_ids, position_keys, aa_change_keys
 
 # read in class I and class II, pepetides 51mer
 # create a key that key that matches the petides 51mer ID
@@ -29,76 +34,56 @@ def parse_arguments():
 
     return(parser.parse_args())
 
-def rearrange_string(s):
-    match = re.match(r'([A-Za-z]+)([\d-]+)([A-Za-z]*)', s)
-    if match:
-        letters_before = match.group(1)
-        numbers = match.group(2)
-        letters_after = match.group(3)
-        
-        #return f"{numbers}{letters_before}/{letters_after}"
-        # Just use the postion for the key to avoid FS problem
-        return f"{numbers}"
-    else:
-        return s
+def insert_around_substring(original_string, target_substring, insert_before, insert_after, matches=None):
+
+    # Wrap every occurrence of the target, overlapping occurrences are wrapped together
+    if matches is None:
+        matches = EpitopeLocator([target_substring]).find_all(original_string)
 
-def insert_around_substring(original_string, target_substring, insert_before, insert_after):
+    new_string = ''
+    previous_end = 0
 
-    new_string = original_string
-    index = original_string.find(target_substring)
-    
-    if index != -1:
-        new_string = (
-            original_string[:index] +
+    for start, end in match_intervals(matches, target_substring):
+        new_string += (
+            original_string[previous_end:start] +
             insert_before +
-            target_substring +
-            insert_after +
-            original_string[index + len(target_substring):]
+            original_string[start:end] +
+            insert_after
         )
-        
-    return new_string
+        previous_end = end
+
+    return new_string + original_string[previous_end:]
 
 
 args = parse_arguments()
 
-peptides_51mer = pd.read_excel(args.p)
+peptides_51mer = read_peptides_table(args.p)
 
-classI = pd.read_csv(args.classI, sep="\t")
+# Only the columns used for the key and the best peptide are read
+pvacseq_columns = ['Gene', 'Best Transcript', 'AA Change', 'Best Peptide']
 
-classII = pd.read_csv(args.classII, sep="\t")
+classI = read_pvacseq_table(args.classI, pvacseq_columns)
+
+classII = read_pvacseq_table(args.classII, pvacseq_columns)
 
 # create ID to be shared by all dataframes
 peptides_51mer.rename(columns={'ID': 'full ID'}, inplace=True)
-peptides_51mer['ID'] = peptides_51mer['full ID']
-
-peptides_51mer['ID'] = peptides_51mer['ID'].apply(lambda x: '.'.join(x.split('.')[1:]))  # Removing before first period, periods will be removed 
-peptides_51mer['ID'] = peptides_51mer['ID'].apply(lambda x: '.'.join(x.split('.')[1:]))  # Removing before second period
-peptides_51mer['ID'] = peptides_51mer['ID'].apply(lambda x: '.'.join(x.split('.')[:3]) + '.' + '.'.join(x.split('.')[4:]))
-
-for index, row in peptides_51mer.iterrows():
-    for i, char in enumerate(row['ID'][::-1]):
-        if char.isdigit():
-            peptides_51mer.at[index, 'ID'] = row['ID'][:-i]
-            break
-    else:
-        result = row['ID']
-
+# the key is gene, transcript and the position of the AA change
+peptides_51mer['ID'] = position_keys(parse_ids(peptides_51mer['full ID']))
 
-# create a key that is gene, transcript, AA change for CLASSI
-classII['modified AA Change'] = classII['AA Change'] 
-# Apply the function to the 'Value' column
-classII['modified AA Change'] = classII['modified AA Change'].apply(rearrange_string)
-classII['ID'] = classII['Gene'] + '.' + classII['Best Transcript'] + '.' + classII['modified AA Change'] 
+classII['ID'] = aa_change_keys(classII['Gene'], classII['Best Transcript'], classII['AA Change'], position_only=True)
 
+classI['ID'] = aa_change_keys(classI['Gene'], classI['Best Transcript'], classI['AA Change'], position_only=True)
 
-# create a key that is gene, transcript, AA change for CLASSI
-classI['modified AA Change'] = classI['AA Change'] 
-# Apply the function to the 'Value' column
-classI['modified AA Change'] = classI['modified AA Change'].apply(rearrange_string)
-classI['ID'] = classI['Gene'] + '.' + classI['Best Transcript'] + '.' + classI['modified AA Change'] 
+# 51mers whose ID does not line up with a class II key are joined through the sequence that contains the class II peptide
+sequence_column = "CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE WITH FLANKING RESIDUES"
+classII_keys, repaired = fallback_keys(peptides_51mer['ID'], peptides_51mer[sequence_column],
+                                       classII['ID'], classII['Best Peptide'])
+if repaired > 0:
+    print(repaired, "51mers were joined by sequence because their ID did not match")
 
 # Merge the sequences from classI and classII with peptide 51mer
-merged_peptide_51mer = pd.merge(peptides_51mer, classII[['ID', 'Best Peptide']], on='ID', how='left')
+merged_peptide_51mer = pd.merge(peptides_51mer.assign(ID=classII_keys), classII[['ID', 'Best Peptide']], on='ID', how='left')
 merged_peptide_51mer.rename(columns = {"Best Peptide":"Best Peptide Class II"}, inplace=True)
 merged_peptide_51mer = pd.merge(merged_peptide_51mer, classI[['ID', 'Best Peptide']], on='ID', how='left')
 merged_peptide_51mer.rename(columns = {"Best Peptide":"Best Peptide Class I"}, inplace=True)
@@ -111,36 +96,39 @@ peptides_51mer_html = peptides_51mer.to_html(index=False) # convert to html
 peptides_51mer_soup = BeautifulSoup(peptides_51mer_html, 'html.parser')
 
 
-# Loop through all peptide 51mer IDs
-for index, row in peptides_51mer.iterrows():
+# Index the merged rows by full ID once, the first merged row is used for each ID
+merged_records = RecordIndex(merged_peptide_51mer, 'full ID')
 
-    search_string = row['full ID']
+# One automaton over all class II peptides
+locator = EpitopeLocator(merged_peptide_51mer['Best Peptide Class II'])
 
-    #classII_sequence 
-    classII_peptide = merged_peptide_51mer.loc[merged_peptide_51mer['full ID'] == search_string, 'Best Peptide Class II'].values[0]
+# The body rows of the html are in the order of the table, the sequence cell of a row is found by its column
+body_rows = peptides_51mer_soup.find('tbody').find_all('tr', recursive=False)
+sequence_cell = list(peptides_51mer.columns).index(sequence_column)
 
-    # Find the tag containing the search string
-    tag_with_search_string = peptides_51mer_soup.find('td', string=search_string)
+# Loop through all peptide 51mer IDs
+for search_string, tr in zip(peptides_51mer['full ID'], body_rows):
 
-    if tag_with_search_string and isinstance(classII_peptide, str):
+    #classII_sequence 
+    record = merged_records.record(search_string, columns=['Best Peptide Class II'])
+    classII_peptide = record['Best Peptide Class II'] if record else None
 
-        # Find the parent <tr> tag of the tag containing the search string
-        parent_tr = tag_with_search_string.find_parent('tr')
-    
-        # Find the next two <td> tags
-        next_td_tags = parent_tr.findChildren('td', limit=3)
+    if isinstance(classII_peptide, str):
 
-        sequence = next_td_tags[2].get_text()
+        sequence_td = tr.find_all('td', recursive=False)[sequence_cell]
 
-        new_string = insert_around_substring(sequence, classII_peptide, '<span style="font-weight:bold;">', '</span>')
+        sequence = sequence_td.get_text()
 
-        next_td_tags[2].string = new_string
+        new_string = insert_around_substring(sequence, classII_peptide, '<span style="font-weight:bold;">', '</span>',
+                                             locator.find_all(sequence))
 
-        modified_html = peptides_51mer_soup.prettify(formatter=None)
+        sequence_td.string = new_string
 
     else:
         print("Search string not found.")
 
+# The html is rendered once after every row is bolded
+modified_html = peptides_51mer_soup.prettify(formatter=None)
 
 with open(args.o, "w", encoding = 'utf-8') as file:
     file.write(modified_html)
\ No newline at end of file
@@ -1,8 +1,12 @@
 import numpy as np
 import pandas as pd
 import re
-from bs4 import BeautifulSoup
+import html
 import argparse
+from record_index import RecordIndex
+from epitope_locator import EpitopeLocator, match_intervals
+from review_io import read_peptides_table, arrow_safe, RichText, StreamingWorkbook
+from pvacseq_io import iter_pvacseq_table, as_text
 
 '''
 Example Command:
@@ -10,31 +14,20 @@ python3 ../scripts/color_peptides51mer.py -p manual_review/JLF-100-051_Peptides_
 '''
 
 
-class AminoAcid:
+# Each residue of a 51mer is annotated with a set of style flags stored in a
+# uint8 array, one entry per residue
+BOLD = 1        # class II peptide
+COLOR = 2       # class I peptide (red)
+UNDERLINE = 4   # mutated position(s) within the class I peptide
+LARGE = 8       # problematic position
 
-    def __init__(self, nucleotide, bold, color, underline, large, position, open_tag, close_tag):
-        self.nucleotide = nucleotide
-        self.bold = bold
-        self.color = color
-        self.underline = underline
-        self.large = large
-        self.position = position 
-        self.open_tag = open_tag
-        self.close_tag = close_tag
-
-    def view(self):
-        print("Nucleotide: ", self.nucleotide)
-        print("Open Tag: ", self.open_tag)
-        print("Close Tag: ", self.close_tag)
-        print("Bold: ", self.bold)
-        print("Color: ",self.color)
-        print("Underline: ", self.underline)
-        print("Large: ", self.large)
+# The column holding the 51mer sequence that is colored in the HTML table
+SEQUENCE_COLUMN = 'CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE WITH FLANKING RESIDUES'
 
 # ---- PARSE ARGUMENTS -------------------------------------------------------
 # Parses command line arguments
 # Enables user help
-def parse_arguments():
+def parse_arguments(argv=None):
     # Parse command line arugments
     parser = argparse.ArgumentParser(description='Color the 51mer peptide')
 
@@ -52,86 +45,71 @@ def parse_arguments():
                         help='Maximum classII percentile  to annotate', default=2, type=float)
     parser.add_argument('-probPos', nargs='*', 
                         help='problematic position to make large', default='')
+    parser.add_argument('-classI',
+                        help='The path to a classI aggregated or all_epitopes tsv, every binding classI epitope is highlighted')
+    parser.add_argument('-classII',
+                        help='The path to a classII aggregated or all_epitopes tsv, every binding classII epitope is highlighted')
+    parser.add_argument('-format', choices=['html', 'xlsx', 'both'], default='html',
+                        help='Write the colored table as html, as an xlsx with rich text sequences, or both')
     parser.add_argument('-o',
                         help='the path to output folder')
 
-    return(parser.parse_args())
+    return(parser.parse_args(argv))
+
+
+def peptide_positions(matches, peptide):
+    # Returns the residue positions covered by every match of the peptide
+    intervals = match_intervals(matches, peptide)
+    if len(intervals) == 0:
+        return np.arange(0)
+    return np.concatenate([np.arange(start, end) for start, end in intervals])
 
 
 def annotate_every_nucleotide(sequence, classI_peptide, classII_peptide, 
                               classI_ic50, classI_percentile, classII_ic50, classII_percentile, 
                               classI_transcript, classII_transcript, 
-                              cIIC50_threshold, cIpercentile_threshold, cIIIC50_threshold, cIIpercent_threshold, probPos):
+                              cIIC50_threshold, cIpercentile_threshold, cIIIC50_threshold, cIIpercent_threshold, probPos, matches=None):
 
-    peptide_sequence = [] # Create a list to hold all AA of the 51mer
+    # Locate the peptides if the matches for this 51mer were not passed in
+    if matches is None:
+        matches = EpitopeLocator([classI_peptide, classII_peptide]).find_all(sequence)
 
-    # Make the sequence a list of AminoAcid objects
-    for i in range(len(sequence)):
-        new_AA = AminoAcid(sequence[i], False, False, False, False, -1, False, False)
-        
-        if len(probPos) > 0 and sequence[i] in probPos:
-            new_AA.large = True
-        
-        peptide_sequence.append(new_AA)
+    # One flag entry per AA of the 51mer
+    residues = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+    peptide_flags = np.zeros(len(residues), dtype=np.uint8)
+
+    if len(probPos) > 0:
+        problematic = np.frombuffer(''.join(probPos).encode('ascii'), dtype=np.uint8)
+        peptide_flags[np.isin(residues, problematic)] |= LARGE
 
     # CLASS I
-    positions = []
-    # Get the positions in the peptide_sequence where the classI is located
-    for i in range(len(peptide_sequence)):
-        for j in range(len(classI_peptide)):
-            if peptide_sequence[i].nucleotide == classI_peptide[j]:
-                positions.append(i)
-                i+=1
-            else:
-                break
-
-        if len(positions) == len(classI_peptide):
-            break
-        else:
-            positions = []
-            
-    # set those positions to red
+    # set every match of the classI peptide to red
     # if median affinity < 1000 nm OR percentile < 2%
-    j = 0
     if float(classI_ic50) < cIIC50_threshold or float(classI_percentile) < cIpercentile_threshold:
-        for i in range(len(peptide_sequence)):
-            if j < len(positions) and i == positions[j]:
-                peptide_sequence[i].color = True
-                j+=1
+        peptide_flags[peptide_positions(matches, classI_peptide)] |= COLOR
 
     if classI_transcript == classII_transcript:
-        # CLASS II         
-        positions = []
-        for i in range(len(peptide_sequence)):
-            for j in range(len(classII_peptide)):
-                if peptide_sequence[i].nucleotide == classII_peptide[j]:
-                    positions.append(i)
-                    i+=1
-                else:
-                    break
-
-            if len(positions) == len(classII_peptide):
-                break
-            else:
-                positions = []
+        # CLASS II
         # Set class II to bold
         # if percentile < 2% 
-        j = 0
         if float(classII_percentile) < cIIpercent_threshold or float(classII_ic50) < cIIIC50_threshold:
-            for i in range(len(peptide_sequence)):
-                if j < len(positions) and i == positions[j]:
-                    peptide_sequence[i].bold = True
-                    j+=1
+            peptide_flags[peptide_positions(matches, classII_peptide)] |= BOLD
     else:
         print("Note: ClassII transcript different then ClassI. ClassII peptide not bolded.")
-    
 
-    return(peptide_sequence)
+    return(peptide_flags)
 
-def set_underline(peptide_sequence, mutant_peptide_pos, row_ID):
+def classI_run_positions(peptide_flags):
+    # 1-based position of each residue within its run of red (classI) residues, 0 outside of a run
+    colored = (peptide_flags & COLOR).astype(bool)
+    index = np.arange(1, len(peptide_flags) + 1)
+    run_start = np.where(colored, 0, index)
+    np.maximum.accumulate(run_start, out=run_start)
+    return np.where(colored, index - run_start, 0)
+
+def set_underline(peptide_flags, mutant_peptide_pos, row_ID):
 
     frameshift = False
-    classI_position = 0
 
     # Determine if frameshift mutation by seraching for = '-'
     if ',' in mutant_peptide_pos:
@@ -149,180 +127,363 @@ def set_underline(peptide_sequence, mutant_peptide_pos, row_ID):
     else:
         mutant_peptide_pos = int(float(mutant_peptide_pos))
 
-
+    classI_position = classI_run_positions(peptide_flags)
 
     if frameshift:
-        continue_underline = False
-        
-        for i in range(len(peptide_sequence)):
-
-            if peptide_sequence[i].color:
-                classI_position += 1
-            else:
-                 classI_position = 0
-                 continue_underline = False
-
-            if classI_position == start_position:
-                peptide_sequence[i].underline = True
-                continue_underline = True
-            elif continue_underline:
-                peptide_sequence[i].underline = True
-            elif classI_position == end_position:
-                peptide_sequence[i].underline = True
-                continue_underline = False
-            i+=1
+        # underline from the start position to the end of the classI peptide
+        underline = (classI_position >= start_position) | (classI_position == end_position)
     else:
-        for i in range(len(peptide_sequence)):
+        underline = classI_position == mutant_peptide_pos
+
+    peptide_flags[underline] |= UNDERLINE
+
+# ---- EPITOPE TRACKS --------------------------------------------------------
+# Every binding epitope from the classI/classII tsvs is overlaid on the 51mers. Each
+# (HLA class, allele) pair is a track with one bit in a uint64 per residue, so any
+# number of tracks (up to 64) is annotated with a single OR per epitope match.
+MAX_TRACKS = 64
+
+# Column names in the aggregated and the all_epitopes tsvs
+EPITOPE_COLUMNS = {'Best Peptide': 'Epitope', 'MT Epitope Seq': 'Epitope',
+                   'Allele': 'Allele', 'HLA Allele': 'Allele',
+                   'IC50 MT': 'IC50', 'Median MT IC50 Score': 'IC50',
+                   '%ile MT': 'Percentile', 'Median MT Percentile': 'Percentile'}
+
+# Legend colors for residues covered by classI tracks, classII tracks or both
+TRACK_COLORS = {'I': '#ffe0e0', 'II': '#dde8ff', 'I/II': '#eedcff'}
+
+def read_binding_epitopes(path, hla_class, ic50_threshold, percentile_threshold, chunksize=500000):
+    # Returns every (class, allele, epitope) with an IC50 or percentile below the threshold. Only the
+    # EPITOPE_COLUMNS are read, chunk by chunk, and only the binding epitopes of a chunk are kept.
+    # The scores are read as float64 so epitopes right at a threshold are not rounded across it.
+    binding_epitopes = []
+
+    for chunk in iter_pvacseq_table(path, list(EPITOPE_COLUMNS), chunksize, score_dtype=np.float64):
+        chunk = chunk.rename(columns=EPITOPE_COLUMNS)
+        binding = (chunk['IC50'] < ic50_threshold) | (chunk['Percentile'] < percentile_threshold)
+
+        chunk = chunk.loc[binding & chunk['Epitope'].notna(), ['Allele', 'Epitope']]
+        # every chunk has its own allele categories
+        binding_epitopes.append(chunk.assign(Allele=as_text(chunk['Allele'])).drop_duplicates())
+
+    epitopes = pd.concat(binding_epitopes, ignore_index=True) if binding_epitopes else pd.DataFrame(columns=['Allele', 'Epitope'])
+    epitopes.insert(0, 'Class', hla_class)
+
+    return epitopes.drop_duplicates()
+
+class EpitopeTracks:
+
+    def __init__(self, epitopes):
+        tracks = epitopes[['Class', 'Allele']].drop_duplicates().sort_values(['Class', 'Allele'])
+        if len(tracks) > MAX_TRACKS:
+            raise ValueError(f"{len(tracks)} epitope tracks found, at most {MAX_TRACKS} can be colored")
+
+        self.tracks = list(tracks.itertuples(index=False, name=None))
+        self.bits = np.left_shift(np.uint64(1), np.arange(len(self.tracks), dtype=np.uint64))
+
+        track_bits = dict(zip(self.tracks, self.bits))
+        epitope_track_bits = np.array([track_bits[track] for track in zip(epitopes['Class'], epitopes['Allele'])], dtype=np.uint64)
+
+        # All tracks an epitope belongs to, combined into a single bitset
+        self.epitope_bits = pd.Series(epitope_track_bits, index=epitopes['Epitope'].to_numpy()) \
+            .groupby(level=0).agg(np.bitwise_or.reduce).to_dict()
+
+        self.class_masks = {}
+        for hla_class in ['I', 'II']:
+            class_bits = [bit for track, bit in zip(self.tracks, self.bits) if track[0] == hla_class]
+            self.class_masks[hla_class] = np.bitwise_or.reduce(np.array(class_bits, dtype=np.uint64))
+
+    def __len__(self):
+        return len(self.tracks)
+
+    @property
+    def epitopes(self):
+        return list(self.epitope_bits)
+
+    def residue_bits(self, sequence_length, matches):
+        # uint64 per residue with the bits of every track that has an epitope covering it
+        bits = np.zeros(sequence_length, dtype=np.uint64)
+        for epitope, starts in matches.items():
+            epitope_bits = self.epitope_bits.get(epitope)
+            if epitope_bits is None:
+                continue
+            for start in starts:
+                bits[start:start + len(epitope)] |= epitope_bits
+        return bits
+
+    def track_class(self, bits):
+        # Collapses a bitset into the legend entry ('I', 'II', 'I/II' or '')
+        classI = bool(bits & self.class_masks['I'])
+        classII = bool(bits & self.class_masks['II'])
+        if classI and classII:
+            return 'I/II'
+        return 'I' if classI else ('II' if classII else '')
+
+    def track_names(self, bits):
+        return [f"Class {hla_class} {allele}" for (hla_class, allele), bit in zip(self.tracks, self.bits) if bits & bit]
+
+def set_span_tags(peptide_flags, track_bits=None):
+    # Run-length pass over the flags (and tracks), a new span is opened wherever the style changes
+    changed = peptide_flags[1:] != peptide_flags[:-1]
+    styled = len(peptide_flags) > 0 and peptide_flags[0] != 0
+    if track_bits is not None:
+        changed |= track_bits[1:] != track_bits[:-1]
+        styled = styled or (len(track_bits) > 0 and track_bits[0] != 0)
+
+    changes = np.flatnonzero(changed) + 1
+    if styled:
+        changes = np.concatenate(([0], changes))
+
+    if track_bits is None:
+        return(changes, peptide_flags[changes])
+    return(changes, peptide_flags[changes], track_bits[changes])
+
+def span_style(flags):
+    style = ''
+    if flags & BOLD:
+        style += 'font-weight:bold;'
+    if flags & COLOR:
+        style += 'color:#ff0000;'
+    if flags & UNDERLINE:
+        style += 'text-decoration:underline;'
+    if flags & LARGE:
+        style += 'font-size:105%;'
+    return style
+
+def span_tag(flags, bits=None, tracks=None):
+    if tracks is None or not bits:
+        return '<span style="' + span_style(flags) + '">'
+
+    style = span_style(flags) + 'background-color:' + TRACK_COLORS[tracks.track_class(bits)] + ';'
+    title = html.escape(', '.join(tracks.track_names(bits)))
+    return '<span style="' + style + '" title="' + title + '">'
+
+def create_stylized_sequence(sequence, span_tags, tracks=None):
+
+    run_starts, run_flags = span_tags[:2]
+    run_bits = span_tags[2] if len(span_tags) > 2 else [None] * len(run_starts)
+
+    if len(run_starts) == 0:
+        return sequence
+
+    # Unstyled residues before the first span
+    new_string = sequence[:run_starts[0]]
+    run_ends = np.append(run_starts[1:], len(sequence))
+
+    for i, (start, end, flags, bits) in enumerate(zip(run_starts, run_ends, run_flags, run_bits)):
+        if i > 0:
+            new_string += '</span>'
+        new_string += span_tag(flags, bits, tracks) + sequence[start:end]
 
-            if peptide_sequence[i].color:
-                classI_position += 1
-            else:
-                 classI_position = 0
-
-            if classI_position == int(mutant_peptide_pos):
-                peptide_sequence[i].underline = True
-            i+=1
-        
-def set_span_tags(peptide_sequence):
-
-    currently_bold = False
-    currently_red = False
-    currently_underlined = False
-    currently_large = False
-    inside_span = False
-
-    for nucleotide in peptide_sequence:
-
-        if currently_bold != nucleotide.bold or currently_red != nucleotide.color or currently_underlined != nucleotide.underline or currently_large != nucleotide.large:
-            
-            nucleotide.open_tag = True
-
-            if inside_span:
-                nucleotide.close_tag = True # only if its inside a span tag
-            else:
-                nucleotide.close_tag = False
-
-
-            currently_bold = nucleotide.bold 
-            currently_red = nucleotide.color
-            currently_underlined = nucleotide.underline
-            currently_large = nucleotide.large
-
-            inside_span = True
-        
-    return(peptide_sequence)
-
-def create_stylized_sequence(peptide_sequence):
-
-    new_string = ''
-
-    for nucleotide in peptide_sequence:
-
-        if nucleotide.open_tag or nucleotide.close_tag:
-            if nucleotide.close_tag:
-                new_string += '</span>'
-                
-            if nucleotide.open_tag:
-                new_string += '<span style="'
-                if nucleotide.bold:
-                    new_string += 'font-weight:bold;'
-                if nucleotide.color:
-                    new_string += 'color:#ff0000;'
-                if nucleotide.underline:
-                    new_string += 'text-decoration:underline;'
-                if nucleotide.large:
-                     new_string += 'font-size:105%;'
-                new_string += '">'
-                new_string += nucleotide.nucleotide
-        else:
-            new_string += nucleotide.nucleotide
     return(new_string)
 
-def main():
-    args = parse_arguments()
+# The same styles as xlsxwriter format properties, for the rich text sequence in the xlsx
+def span_properties(flags):
+    properties = {}
+    if flags & BOLD:
+        properties['bold'] = True
+    if flags & COLOR:
+        properties['font_color'] = '#FF0000'
+    if flags & UNDERLINE:
+        properties['underline'] = 1
+    if flags & LARGE:
+        properties['font_size'] = 11.5
+    return properties
+
+def rich_text_sequence(sequence, span_tags):
+    # The epitope tracks are not part of the rich text, Excel has no per-run background color
+    run_starts, run_flags = span_tags[:2]
+
+    if len(run_starts) == 0:
+        return RichText([(None, sequence)])
+
+    fragments = [(None, sequence[:run_starts[0]])]
+    run_ends = np.append(run_starts[1:], len(sequence))
+    for start, end, flags in zip(run_starts, run_ends, run_flags):
+        fragments.append((span_properties(flags), sequence[start:end]))
+
+    return RichText(fragments)
+
+# ---- HTML TABLE ------------------------------------------------------------
+# The colored table is written straight to the output file one row at a time
+def format_cell(value):
+    if not isinstance(value, str) and pd.isna(value):
+        return 'NaN'
+    return html.escape(str(value))
+
+def format_column(column):
+    # Floats get six decimals with the trailing zeros trimmed evenly across the column, like to_html
+    if not pd.api.types.is_float_dtype(column):
+        return [format_cell(value) for value in column]
+
+    missing = column.isna().to_numpy()
+    values = ['{:.6f}'.format(value) for value in column]
+    present = [value for value, is_missing in zip(values, missing) if not is_missing]
+
+    trim = 0
+    while present and all(value[len(value) - trim - 1] == '0' and value[len(value) - trim - 2] != '.' for value in present):
+        trim += 1
+
+    return ['NaN' if is_missing else value[:len(value) - trim] for value, is_missing in zip(values, missing)]
+
+def write_table_header(file, columns):
+    file.write('<table border="1" class="dataframe">\n')
+    file.write(' <thead>\n  <tr style="text-align: right;">\n')
+    for column in columns:
+        file.write('   <th>' + html.escape(str(column)) + '</th>\n')
+    file.write('  </tr>\n </thead>\n <tbody>\n')
+
+def write_table_row(file, cells):
+    file.write('  <tr>\n')
+    for cell in cells:
+        file.write('   <td>' + cell + '</td>\n')
+    file.write('  </tr>\n')
+
+def write_track_legend(file, tracks):
+    file.write('<table border="1" class="legend">\n')
+    file.write(' <thead>\n  <tr>\n   <th>Track</th>\n   <th>HLA Class</th>\n   <th>Allele</th>\n  </tr>\n </thead>\n <tbody>\n')
+    for number, (hla_class, allele) in enumerate(tracks.tracks, start=1):
+        file.write('  <tr>\n')
+        file.write('   <td>' + str(number) + '</td>\n')
+        file.write('   <td><span style="background-color:' + TRACK_COLORS[hla_class] + ';">Class ' + hla_class + '</span></td>\n')
+        file.write('   <td>' + html.escape(str(allele)) + '</td>\n')
+        file.write('  </tr>\n')
+    file.write('  <tr>\n   <td></td>\n   <td><span style="background-color:' + TRACK_COLORS['I/II'] + ';">Class I/II</span></td>\n   <td>overlapping</td>\n  </tr>\n')
+    file.write(' </tbody>\n</table>\n<br>\n')
+
+def write_table_footer(file):
+    file.write(' </tbody>\n</table>\n')
+
+# ---- RESTRICTING HLA ALLELE ------------------------------------------------
+# The classI allele is restricting if the classI peptide is below the classI IC50 OR percentile
+# threshold, the same goes for classII. Both alleles are joined with a '/'.
+def binding_mask(peptides_51mer, hla_class, ic50_threshold, percentile_threshold):
+    ic50 = pd.to_numeric(peptides_51mer[f'Class {hla_class} IC50 MT'], errors='coerce')
+    percentile = pd.to_numeric(peptides_51mer[f'Class {hla_class} %ile MT'], errors='coerce')
+    allele = peptides_51mer[f'Class {hla_class} Allele']
+    return ((ic50 < ic50_threshold) | (percentile < percentile_threshold)) & allele.notna()
+
+def restricting_hla_alleles(peptides_51mer, cIIC50_threshold, cIpercentile_threshold, cIIIC50_threshold, cIIpercent_threshold):
+    classI = binding_mask(peptides_51mer, 'I', cIIC50_threshold, cIpercentile_threshold)
+    classII = binding_mask(peptides_51mer, 'II', cIIIC50_threshold, cIIpercent_threshold)
+
+    classI_allele = peptides_51mer['Class I Allele'].where(classI, '').astype(str)
+    classII_allele = peptides_51mer['Class II Allele'].where(classII, '').astype(str)
+    separator = pd.Series(np.where(classI & classII, '/', ''), index=peptides_51mer.index)
+
+    return classI_allele + separator + classII_allele
+
+def main(args=None, peptides_51mer=None):
+    if args is None:
+        args = parse_arguments()
     
-    # read in classI and class II
-    peptides_51mer = pd.read_excel(args.peptides)
+    # read in classI and class II, setup_review.py passes the table generate_reviews_files just wrote
+    if peptides_51mer is None:
+        peptides_51mer = read_peptides_table(args.peptides)
+    else:
+        # the same column types the sidecar would have been read back with
+        peptides_51mer = arrow_safe(peptides_51mer)
  
     # Fill in the Restricting HLA Allele Column
-    for index, row in peptides_51mer.iterrows():
-        restricting_alleles = ''
-        if (float(row['Class I IC50 MT']) < args.cIIC50 or float(row['Class I %ile MT']) <  args.cIpercent):
-            restricting_alleles = row['Class I Allele']
-        
-        if (float(row['Class I IC50 MT']) < args.cIIIC50 or float(row['Class I %ile MT']) <  args.cIIpercent):
-            
-            if restricting_alleles != '':
-                restricting_alleles = restricting_alleles + '/' + row['Class II Allele']
-            else:
-                 restricting_alleles =  row['Class II Allele']
-        
-        peptides_51mer.at[index, 'RESTRICTING HLA ALLELE'] = restricting_alleles
-                
+    peptides_51mer['RESTRICTING HLA ALLELE'] = restricting_hla_alleles(peptides_51mer, args.cIIC50, args.cIpercent, args.cIIIC50, args.cIIpercent)
 
-    # convert peptide 51mer to HTML
-    peptides_51mer_html = peptides_51mer.to_html(index=False) # convert to html
-
-    # Creating a BeautifulSoup object and specifying the parser
-    peptides_51mer_soup = BeautifulSoup(peptides_51mer_html, 'html.parser')
-
-    for index, row in peptides_51mer.iterrows():
-
-        search_string = row['51mer ID']
+    if args.o:
+        html_file_name = args.o + args.samp + ".Colored_Peptides.html" 
+        xlsx_file_name = args.o + args.samp + ".Colored_Peptides.xlsx"
+    else:
+        html_file_name  =  args.samp + ".Colored_Peptides.html"
+        xlsx_file_name  =  args.samp + ".Colored_Peptides.xlsx"
+
+    write_html = args.format in ['html', 'both']
+    write_xlsx = args.format in ['xlsx', 'both']
+
+    # The 51mer ID is only used to look up the row and is left out of the output
+    html_columns = [column for column in peptides_51mer.columns if column != '51mer ID']
+    sequence_cell = html_columns.index(SEQUENCE_COLUMN)
+    if write_html:
+        formatted_columns = [format_column(peptides_51mer[column]) for column in html_columns]
+
+    # Overlay every binding epitope from the classI/classII tsvs if they were given
+    tracks = None
+    binding_epitopes = []
+    if args.classI:
+        binding_epitopes.append(read_binding_epitopes(args.classI, 'I', args.cIIC50, args.cIpercent))
+    if args.classII:
+        binding_epitopes.append(read_binding_epitopes(args.classII, 'II', args.cIIIC50, args.cIIpercent))
+    if binding_epitopes:
+        tracks = EpitopeTracks(pd.concat(binding_epitopes, ignore_index=True))
+        print(f"Overlaying {len(tracks.epitopes)} binding epitopes on {len(tracks)} allele tracks")
+
+    html_file = None
+    if write_html:
+        html_file = open(html_file_name, "w", encoding = 'utf-8')
+        if tracks is not None:
+            write_track_legend(html_file, tracks)
+        write_table_header(html_file, html_columns)
+
+    # The xlsx is streamed row by row with the colored sequence as rich text
+    workbook = StreamingWorkbook(xlsx_file_name, html_columns) if write_xlsx else None
+
+    # Every 51mer ID is looked up in an index built once for the table, rows that
+    # share a 51mer ID are matched to their records in table order
+    records = RecordIndex(peptides_51mer, '51mer ID')
+    occurrences = {}
+
+    # One automaton over all class I and class II peptides of the sample
+    locator_epitopes = list(peptides_51mer['Best Peptide Class I']) + list(peptides_51mer['Best Peptide Class II'])
+    if tracks is not None:
+        locator_epitopes += tracks.epitopes
+    locator = EpitopeLocator(locator_epitopes)
+
+    for row_number, search_string in enumerate(peptides_51mer['51mer ID']):
+
+        occurrence = occurrences.get(search_string, 0)
+        occurrences[search_string] = occurrence + 1
+        record = records.record(search_string, occurrence)
+        if record is None:
+            record = records.record_at(row_number)
 
         # classII sequence 
-        classII_peptide = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Best Peptide Class II'].values[0]
+        classII_peptide = record['Best Peptide Class II']
         # classI sequence 
-        classI_peptide = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Best Peptide Class I'].values[0]
+        classI_peptide = record['Best Peptide Class I']
         # mutant peptide position
-        mutant_peptide_pos = str(peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Pos'].values[0])
+        mutant_peptide_pos = str(record['Pos'])
         # classI IC50
-        classI_ic50 = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Class I IC50 MT'].values[0]
+        classI_ic50 = record['Class I IC50 MT']
         # classI percentile
-        classI_percentile = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Class I %ile MT'].values[0]
+        classI_percentile = record['Class I %ile MT']
         # classII IC50
-        classII_ic50 = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Class II IC50 MT'].values[0]
+        classII_ic50 = record['Class II IC50 MT']
         # classII percentile
-        classII_percentile = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Class II %ile MT'].values[0]
+        classII_percentile = record['Class II %ile MT']
         # classI transcript
-        classI_transcript = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Class I Best Transcript'].values[0]
+        classI_transcript = record['Class I Best Transcript']
         # classI transcript
-        classII_transcript = peptides_51mer.loc[peptides_51mer['51mer ID'] == search_string, 'Class II Best Transcript'].values[0]
-
-
-        # Find the tag containing the search string
-        tag_with_search_string = peptides_51mer_soup.find('td', string=search_string)
+        classII_transcript = record['Class II Best Transcript']
 
-        if tag_with_search_string and isinstance(classII_peptide, str):
+        sequence = str(record[SEQUENCE_COLUMN])
+        matches = locator.find_all(sequence)
+        track_bits = None if tracks is None else tracks.residue_bits(len(sequence), matches)
+        span_tags = None
 
-            # Find the parent <tr> tag of the tag containing the search string
-            parent_tr = tag_with_search_string.find_parent('tr')    
-            # Find the next two <td> tags
-            next_td_tags = parent_tr.findChildren('td', limit=3)
-            
-            sequence = next_td_tags[2].get_text()
+        if isinstance(search_string, str) and isinstance(classII_peptide, str):
 
-            # make sequence the list of objects
+            # annotate the style flags of every AA in the sequence
             peptide_sequence = annotate_every_nucleotide(sequence, classI_peptide, classII_peptide, 
                                                          classI_ic50, classI_percentile, classII_ic50, classII_percentile,
                                                          classI_transcript, classII_transcript,
-                                                         args.cIIC50, args.cIpercent, args.cIIIC50, args.cIIpercent, args.probPos)
+                                                         args.cIIC50, args.cIpercent, args.cIIIC50, args.cIIpercent, args.probPos,
+                                                         matches)
 
             # actaully lets break class I and classII into two steps and handle the mutated nucleotide in class I function
             # it should be basically like at that position in the class I set 
             
-            set_underline(peptide_sequence, mutant_peptide_pos, row['51mer ID'])
+            set_underline(peptide_sequence, mutant_peptide_pos, search_string)
 
-            set_span_tags(peptide_sequence) # pass by reference
+            span_tags = set_span_tags(peptide_sequence, track_bits)
             
-            print(row['51mer ID'])
-            new_string = create_stylized_sequence(peptide_sequence)
-
-            next_td_tags[2].string = new_string
-
-            # Remove the tag_with_search_string from the BeautifulSoup tree
-            tag_with_search_string.decompose()
-
+            print(search_string)
 
         else:
             print("\nNOT FOUND: ", search_string)
@@ -330,22 +491,30 @@ def main():
             print("ClassI: ", classI_peptide)
             print("ClassII: ", classII_peptide, "\n")
 
+            # The binding epitopes are still overlaid when the best peptides are not found
+            if tracks is not None:
+                span_tags = set_span_tags(np.zeros(len(sequence), dtype=np.uint8), track_bits)
 
-        tag_with_search_string = peptides_51mer_soup.select_one('th:-soup-contains("51mer ID")')
-        if tag_with_search_string:
-            tag_with_search_string.decompose()
-        # Now 'soup' contains the modified HTML with the tag removed
-        modified_html = peptides_51mer_soup.prettify(formatter=None)
+        if html_file:
+            cells = [column[row_number] for column in formatted_columns]
+            if span_tags is not None:
+                cells[sequence_cell] = create_stylized_sequence(sequence, span_tags, tracks)
+            write_table_row(html_file, cells)
+
+        if workbook:
+            values = list(records.record_at(row_number, html_columns).values())
+            if span_tags is not None:
+                values[sequence_cell] = rich_text_sequence(sequence, span_tags)
+            workbook.write_row(values)
 
         print()
 
-    if args.o:
-        html_file_name = args.o + args.samp + ".Colored_Peptides.html" 
-    else:
-        html_file_name  =  args.o + ".Colored_Peptides.html"
+    if html_file:
+        write_table_footer(html_file)
+        html_file.close()
 
-    with open(html_file_name, "w", encoding = 'utf-8') as file:
-        file.write( modified_html)
+    if workbook:
+        workbook.close()
 
 
 if __name__ == "__main__":
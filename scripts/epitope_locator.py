@@ -0,0 +1,154 @@
+from collections import deque
+
+'''
+Locates class I and class II epitopes inside 51mer sequences. One Aho-Corasick
+automaton is built over all epitopes of a sample, then each 51mer is scanned
+once and every match position of every epitope is returned.
+
+Example:
+locator = EpitopeLocator(peptides_51mer['Best Peptide Class I'])
+matches = locator.find_all('PMWILGHGCYKSDDFFCDVPTKTIHWQWKRSNDMYESWMHIAKEINGMQCE')
+matches['SWMHIAKEI']  # [35]
+
+KmerIndex goes the other way: it indexes the 51mer sequences of a sample and
+returns the 51mers that contain an epitope. It is used to join epitopes to 51mers
+whose ID based keys do not line up.
+'''
+
+
+class EpitopeLocator:
+
+    def __init__(self, epitopes):
+        # Missing (NaN) and empty epitopes are skipped
+        self.epitopes = sorted({epitope for epitope in epitopes if isinstance(epitope, str) and epitope != ''})
+
+        # Trie of all epitopes, node 0 is the root
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for epitope in self.epitopes:
+            node = 0
+            for residue in epitope:
+                child = self.goto[node].get(residue)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][residue] = child
+                node = child
+            self.output[node].append(epitope)
+
+        # Failure links point to the longest suffix of a node that is also in the trie
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for residue, child in self.goto[node].items():
+                queue.append(child)
+
+                suffix = self.fail[node]
+                while suffix and residue not in self.goto[suffix]:
+                    suffix = self.fail[suffix]
+                if node != 0 and residue in self.goto[suffix]:
+                    self.fail[child] = self.goto[suffix][residue]
+
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def __len__(self):
+        return len(self.epitopes)
+
+    def find_all(self, sequence):
+        # Returns a dict of epitope -> list of 0-based start positions of every match
+        matches = {}
+        node = 0
+
+        for i, residue in enumerate(sequence):
+            while node and residue not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(residue, 0)
+
+            for epitope in self.output[node]:
+                matches.setdefault(epitope, []).append(i - len(epitope) + 1)
+
+        return matches
+
+
+def match_intervals(matches, epitope):
+    # Start and end (exclusive) of every match of one epitope, overlapping matches are merged
+    intervals = []
+    if not isinstance(epitope, str):
+        return intervals
+
+    for start in sorted(matches.get(epitope, [])):
+        end = start + len(epitope)
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1][1] = max(intervals[-1][1], end)
+        else:
+            intervals.append([start, end])
+
+    return intervals
+
+
+# ---- K-MER INDEX -----------------------------------------------------------
+class KmerIndex:
+    # Inverted index from every k-mer to the sequences (by position) that contain it.
+    # The shortest class I epitopes are 8 residues, so k=8 covers every epitope.
+
+    def __init__(self, sequences, k=8):
+        self.k = k
+        self.sequences = [sequence if isinstance(sequence, str) else '' for sequence in sequences]
+        self.postings = {}
+
+        for position, sequence in enumerate(self.sequences):
+            for i in range(len(sequence) - k + 1):
+                self.postings.setdefault(sequence[i:i + k], set()).add(position)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def positions_containing(self, epitope):
+        # Sorted positions of the sequences that contain the epitope
+        if not isinstance(epitope, str) or epitope == '':
+            return []
+
+        if len(epitope) < self.k:
+            candidates = range(len(self.sequences))
+        else:
+            # Both the first and the last k-mer of the epitope have to be in the sequence
+            candidates = self.postings.get(epitope[:self.k], set()) & self.postings.get(epitope[-self.k:], set())
+
+        return sorted(position for position in candidates if epitope in self.sequences[position])
+
+
+def fallback_keys(keys, sequences, epitope_keys, epitopes, k=8):
+    # Repairs the join keys of 51mers that match no epitope key. An epitope whose key matches
+    # no 51mer is joined to the 51mer that contains it, if exactly one unmatched 51mer does.
+    # Returns the keys and the number of 51mers that were repaired.
+    keys = list(keys)
+    known_epitope_keys = set(epitope_keys)
+    known_keys = set(keys)
+
+    unmatched = {position for position, key in enumerate(keys) if key not in known_epitope_keys}
+    if not unmatched:
+        return keys, 0
+
+    index = KmerIndex(sequences, k)
+    repaired = 0
+    for epitope_key, epitope in zip(epitope_keys, epitopes):
+        if epitope_key in known_keys:
+            continue
+
+        positions = [position for position in index.positions_containing(epitope) if position in unmatched]
+        if len(positions) == 1:
+            keys[positions[0]] = epitope_key
+            unmatched.discard(positions[0])
+            known_keys.add(epitope_key)
+            repaired += 1
+
+    return keys, repaired
+
+def contained(epitopes, sequences):
+    # For every row, False when the epitope is given but is not in the sequence of that row
+    return [not isinstance(epitope, str) or (isinstance(sequence, str) and epitope in sequence)
+            for epitope, sequence in zip(epitopes, sequences)]
@@ -1,9 +1,14 @@
 import argparse
 import csv
+import numpy as np
 import pandas as pd
 import sys
-from Bio.SeqUtils.ProtParam import ProteinAnalysis
 import re
+from review_io import write_sidecar, write_review_workbook
+from peptide_metrics import molecular_weights
+from peptide_ids import make_unique, parse_ids, candidate_names, transcript_keys, variant_keys, aa_change_keys
+from epitope_locator import fallback_keys, contained
+from pvacseq_io import read_pvacseq_table, top_epitopes, as_text, widen_columns, AGGREGATED_COLUMNS, ALL_EPITOPES_COLUMNS
 
 '''
 Write a script to create the files for the Case Final Reports
@@ -18,7 +23,7 @@ python3 ../scripts/generate_reviews_files.py -a itb-review-files/*.xlsx -c gener
 # ---- PARSE ARGUMENTS -------------------------------------------------------
 # Parses command line arguments
 # Enables user help
-def parse_arguments():
+def parse_arguments(argv=None):
     # Parse command line arugments
     parser = argparse.ArgumentParser(description='Create the file needed for the neoantigen manuel review')
 
@@ -38,91 +43,58 @@ def parse_arguments():
                         help='the path to output folder')
     parser.add_argument('-all_epitopes',
                         help='If you want to generate 51mer for all epitopes', required=False)
+    parser.add_argument('-top_epitopes', type=int,
+                        help='With -all_epitopes, only keep the N best epitopes (lowest IC50, then percentile) of every variant per class before class I and class II are joined. The scores of the kept epitopes are rounded to float32 (about 7 significant digits)', required=False)
 
 
     # The name of the final results folder 
     parser.add_argument('-f', "--fin_results", help="Name of the final results folder in gcp immuno")
 
-    return(parser.parse_args())
-
-# Fucnction to break the pepetides ID on the . to extract gene and AA information
-def extract_info(value):
-    parts = value.split('.')
-    result = '.'.join([parts[2], parts[3], parts[4]])
-    return result
-
-# Function to rearrange string so that G518D looks like 518G/D
-def rearrange_string(s):
-    match = re.match(r'([A-Za-z]+)([\d-]+)([A-Za-z]*)', s)
-    if match:
-        letters_before = match.group(1)
-        numbers = match.group(2)
-        letters_after = match.group(3)
-                
-        return f"{numbers}{letters_before}/{letters_after}"
-    else:
-        return s
-    
-# Function to calculate molecular weight---------------------------------------
-def calculate_molecular_weight(peptide):
-    analyzed_seq = ProteinAnalysis(peptide)
-    return analyzed_seq.molecular_weight()
-
-# Function to make id column unique -------------------------------------------
-def make_column_unique(df, column_name):
-    seen_values = set()
-    new_values = []
-
-    for value in df[column_name]:
-        if value in seen_values:
-            suffix = 1
-            while f"{value}.{suffix}" in seen_values:
-                suffix += 1
-            unique_value = f"{value}.{suffix}"
-        else:
-            unique_value = value
-
-        seen_values.add(unique_value)
-        new_values.append(unique_value)
-
-    df[column_name] = new_values
-    return df
+    return(parser.parse_args(argv))
 
 # Function that fills the "Variant Called by CLE Pipeline" column based on the matching variant values
 # for "VALIDATED" in the variants.final.annotated.tsv file
+
+def variant_coordinates(variants):
+    # Start and end of every variant the way pVACseq writes them in the ID column
+    pos = variants["POS"].to_numpy(dtype=np.int64)
+    ref_len = variants["REF"].astype(str).str.len().to_numpy()
+    alt_len = variants["ALT"].astype(str).str.len().to_numpy()
+
+    substitution = ref_len == alt_len
+    insertion = ref_len < alt_len
+
+    start_pos = np.where(substitution, pos - ref_len, pos)
+    end_pos = np.where(substitution | insertion, pos, pos + ref_len - 1)
+    return start_pos, end_pos
+
 def fill_variant_called_column(df, variants):
     df.reset_index(drop=True, inplace=True)
 
-    start_pos = []
-    end_pos = []
-
-    for ref, alt, pos in zip(variants["REF"], variants["ALT"], variants["POS"]):
-        if len(ref) == len(alt):  # Substitution
-            start_pos.append(pos - len(ref))
-            end_pos.append(pos)
-        elif len(ref) < len(alt):  # Insertion
-            start_pos.append(pos)
-            end_pos.append(pos)
-        else:  # Deletion
-            start_pos.append(pos)
-            end_pos.append(pos + len(ref) - 1)
-    
-    variants["start_pos"] = start_pos
-    variants["end_pos"] = end_pos
+    # The candidate ID is CHROM-start-end-REF-ALT and the contig name can contain "-" (e.g. HLA-A*01:01:01:01),
+    # so the end position is the third field from the right
+    id_end_pos = pd.to_numeric(df["ID"].astype(object).str.rsplit("-", n=4).str[-3], errors="coerce")
+
+    # Only variants ending at a candidate position can match, the ID of the rest is never built
+    start_pos, end_pos = variant_coordinates(variants)
+    candidate = np.isin(end_pos, id_end_pos.dropna().to_numpy(dtype=np.int64))
+    variants = variants[candidate]
 
-    variants["ID"] = variants["CHROM"].astype(str) + "-" + \
-                 variants["start_pos"].astype(str) + "-" + \
-                 variants["end_pos"].astype(str) + "-" + \
-                 variants["REF"].astype(str) + "-" + \
-                 variants["ALT"].astype(str)
+    called_variants = pd.DataFrame({"ID": variants["CHROM"].astype(str).to_numpy() + "-" + start_pos[candidate].astype(str) + "-" +
+                                          end_pos[candidate].astype(str) + "-" + variants["REF"].astype(str).to_numpy() + "-" +
+                                          variants["ALT"].astype(str).to_numpy(),
+                                    "VALIDATED": variants["VALIDATED"].to_numpy()})
+    # a variant listed twice would otherwise duplicate the candidate row in the merge
+    called_variants = called_variants.drop_duplicates(subset="ID")
 
-    common_variants = df.merge(variants[["ID", "VALIDATED"]], on="ID", how="left")
+    common_variants = df[["ID"]].astype({"ID": str}).merge(called_variants, on="ID", how="left")
     with pd.option_context('mode.chained_assignment', None):
         df["Variant Called by CLE Pipeline"] = common_variants["VALIDATED"].fillna(False)
 
-def main():
+def main(args=None):
 
-    args = parse_arguments()
+    if args is None:
+        args = parse_arguments()
     
     # Creating the Reviewed Candidates Sheet
     reviewed_candidates =  pd.read_csv(args.reviewed_candidates, sep="\t")
@@ -141,7 +113,7 @@ def main():
     # create sorting ID that is gene and transcript to sort in the same order as peptide
     reviewed_candidates['sorting id'] = reviewed_candidates['Gene']  + '.' + reviewed_candidates['Best Transcript']
     # make sure the sorting id column is unique
-    reviewed_candidates = make_column_unique(reviewed_candidates, 'sorting id')
+    reviewed_candidates['sorting id'] = make_unique(reviewed_candidates['sorting id'])
 
     # Creating the Peptides 51mer Sheet -----------------------------------
     peptides = pd.read_csv(args.peptides, sep="\t")
@@ -149,12 +121,14 @@ def main():
                                  'difficult_n_terminal_residue', 'c_terminal_cysteine', 'c_terminal_proline', 'max_7mer_gravy_score'], axis=1)
     peptides["RESTRICTING HLA ALLELE"] = " "
 
-    peptides["CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE MW (CLIENT)"] = peptides["peptide_sequence"].apply(calculate_molecular_weight)
+    # Molecular weights are computed in one batch, same values as Biopython's ProteinAnalysis
+    peptides["CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE MW (CLIENT)"] = molecular_weights(peptides["peptide_sequence"])
 
     peptides = peptides.rename(columns={"id":"ID", "peptide_sequence":"CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE WITH FLANKING RESIDUES"})
     peptides["Comments"] = " "
-    peptides["CANDIDATE NEOANTIGEN"] = peptides["ID"].apply(lambda x: '.'.join(x.split('.')[:3]))
-    peptides["CANDIDATE NEOANTIGEN"] = args.samp + "." + peptides["CANDIDATE NEOANTIGEN"]
+    # Parse the gene, transcript and variant out of every 51mer ID once
+    peptide_ids = parse_ids(peptides["ID"])
+    peptides["CANDIDATE NEOANTIGEN"] = args.samp + "." + candidate_names(peptide_ids)
 
     peptides = peptides[["ID", "CANDIDATE NEOANTIGEN", "CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE WITH FLANKING RESIDUES", 
                            "RESTRICTING HLA ALLELE", "CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE MW (CLIENT)", "Comments"]]
@@ -163,56 +137,20 @@ def main():
     # create a dataframe that contains the classI and classII pepetide sequence
     # Create a universal ID by editing the peptide 51mer ID
     peptides.rename(columns={'ID': 'full ID'}, inplace=True)
-    peptides['51mer ID'] = peptides['full ID']
-    peptides['51mer ID'] = peptides['51mer ID'].apply(lambda x: '.'.join(x.split('.')[1:]))  # Removes the 'MT' from the beginning of ID column
-    peptides['51mer ID'] = peptides['51mer ID'].apply(lambda x: '.'.join(x.split('.')[1:]))  # Remives the MT index from the ID column
-    
-    def modify_id(x):
-        parts = x.split('.')
-        
-        def is_valid_char(char):
-            return char.isdigit() or char == '-' or (char in ['.', '/'] and parts[-1][parts[-1].index(char)+1].isdigit())
-        
-        if not 'missense' in parts:
-            if 'FS' in parts:
-                # MT.239.KIF7.ENST00000394412.8.FS.405-410CGCGCACTCGGCGCCCAG/C
-                # KIF7.ENST00000394412.FS405-410
-                # If 'FS' is present, remove non-digit characters after the last period
-                last_part = ''.join(filter(is_valid_char, parts[-1]))
-                modified_id = '.'.join(parts[:-1]) + last_part
-            elif 'inframe_del' in parts:
-                # MT.328.DNAAF3.ENST00000391720.8.inframe_del.585-589KTGV*/R
-                # DNAAF3.ENST00000391720.8.KTGV*538-542R
-                last_part = parts[-1]
-                position = re.match(r'[^a-zA-Z]*', last_part).group()
-                aa = re.search(r'[^0-9-]+.*', last_part).group()
-                aa_parts = aa.split('/')
-                modified_id = '.'.join(parts[:3])
-                aa_change = aa_parts[0] + position + aa_parts[1]
-                modified_id = modified_id + "." + aa_change
-            elif 'inframe_ins' in parts:
-                # MT.249.ZCCHC14.ENST00000268616.9.inframe_ins.769H/HH
-                # ZCCHC14.ENST00000268616.9.H769HH
-                modified_id = '.'.join(parts[:3] + parts[4:])
-            else:
-                modified_id = '.'.join(parts[:3] + parts[4:])
-                print("Non missense candidate not accounted for!")
-                print(parts)     
-        else:
-            # If 'missense' or other labels are present, remove them
-            # MT.244.ZP2.ENST00000574002.1.missense.84D/Y
-            # ZP2.ENST00000574002.1.84D/Y
-            modified_id = '.'.join(parts[:3] + parts[4:])
-        
-        return modified_id
-    
-    
-
-    #peptides['51mer ID'] = peptides['51mer ID'].apply(lambda x: '.'.join(x.split('.')[:3]) + '.' + '.'.join(x.split('.')[4:])) # removes the variant label
-    peptides['51mer ID'] = peptides['51mer ID'].apply(modify_id)
-
-    classI = pd.read_csv(args.classI, sep="\t", low_memory=False)
-    classII = pd.read_csv(args.classII, sep="\t",low_memory=False)
+    peptides['51mer ID'] = variant_keys(peptide_ids)
+    peptides['sorting id'] = transcript_keys(peptide_ids) # creating a ID to sort reviewed canidates by the order of the 51mer
+
+    # Only the columns used below are read
+    pvacseq_columns = ALL_EPITOPES_COLUMNS if args.all_epitopes else AGGREGATED_COLUMNS
+    if args.all_epitopes and args.top_epitopes:
+        # the tables are streamed in chunks and reduced to the best epitopes per Index
+        classI, pruned = top_epitopes(args.classI, pvacseq_columns, args.top_epitopes)
+        print("Class I: kept", len(classI), "epitopes, pruned", pruned)
+        classII, pruned = top_epitopes(args.classII, pvacseq_columns, args.top_epitopes)
+        print("Class II: kept", len(classII), "epitopes, pruned", pruned)
+    else:
+        classI = read_pvacseq_table(args.classI, pvacseq_columns)
+        classII = read_pvacseq_table(args.classII, pvacseq_columns)
     if args.all_epitopes:
         classI.rename(columns = {"MT Epitope Seq":"Best Peptide Class I", "HLA Allele":"Class I Allele", 
                                  "Median MT IC50 Score":"Class I IC50 MT", "Median MT Percentile":"Class I %ile MT", 
@@ -221,13 +159,12 @@ def main():
                                   "Median MT IC50 Score":"Class II IC50 MT", "Median MT Percentile":"Class II %ile MT", 
                                   "Transcript":"Class II Best Transcript"}, inplace=True)
         
-        classI['position AA Change'] = classI['Index'].apply(lambda x: x.split('.')[5] if isinstance(x, str) else None)
-        classII['position AA Change'] = classII['Index'].apply(lambda x: x.split('.')[5] if isinstance(x, str) else None)
+        classI['position AA Change'] = parse_ids(classI['Index'])['change']
         
         classI['Pos'] =  classI['Mutation Position']
         classI['AA Change'] =  classI['Mutation']
         
-        classI['51mer ID'] = classI['Gene Name'] + '.' + classI['Class I Best Transcript'] + '.' + classI['position AA Change'] 
+        classI['51mer ID'] = as_text(classI['Gene Name']) + '.' + as_text(classI['Class I Best Transcript']) + '.' + classI['position AA Change'] 
         class_sequences = pd.merge(classI[['Index', 'Best Peptide Class I', '51mer ID', 'Pos', 'AA Change', 'Class I Allele', "Class I IC50 MT", "Class I %ile MT", "Class I Best Transcript"]], 
                                    classII[['Index', 'Best Peptide Class II', 'Class II Allele', "Class II IC50 MT", "Class II %ile MT", "Class II Best Transcript"]], on='Index', how='left')
         class_sequences = class_sequences.drop(columns=['Index'])
@@ -240,31 +177,31 @@ def main():
                                   "IC50 MT":"Class II IC50 MT", "%ile MT":"Class II %ile MT", 
                                   "Best Transcript":"Class II Best Transcript"}, inplace=True)
     
-        def rearrange_string(s):
-            match = re.match(r'([A-Za-z]+)([\d-]+)([A-Za-z]+)', s)
-            if match:
-                letters_before = match.group(1)
-                numbers = match.group(2)
-                letters_after = match.group(3)
-                    
-                return f"{numbers}{letters_before}/{letters_after}"
-                    # Just use the postion for the key to avoid FS problem
-                #return f"{numbers}"
-            else:
-                return s
-        
-    
-        classI['position AA Change'] = classI['AA Change'].apply(rearrange_string)
-        classI['51mer ID'] = classI['Gene'] + '.' + classI['Class I Best Transcript'] + '.' + classI['position AA Change'] 
+        classI['51mer ID'] = aa_change_keys(classI['Gene'], classI['Class I Best Transcript'], classI['AA Change'])
         class_sequences = pd.merge(classI[['ID', 'Best Peptide Class I', '51mer ID', 'Pos', 'AA Change', 'Class I Allele', "Class I IC50 MT", "Class I %ile MT", "Class I Best Transcript"]], 
                                    classII[['ID', 'Best Peptide Class II', 'Class II Allele', "Class II IC50 MT", "Class II %ile MT", "Class II Best Transcript"]], on='ID', how='left')
         class_sequences = class_sequences.drop(columns=['ID'])
 
     
-    merged_peptide_51mer = pd.merge(peptides, class_sequences, on='51mer ID', how='left')
+    # 51mers whose ID does not line up with a class I key are joined through the sequence that contains the class I peptide
+    sequence_column = "CANDIDATE NEOANTIGEN AMINO ACID SEQUENCE WITH FLANKING RESIDUES"
+    peptides['join ID'], repaired = fallback_keys(peptides['51mer ID'], peptides[sequence_column],
+                                                  class_sequences['51mer ID'], class_sequences['Best Peptide Class I'])
+    if repaired > 0:
+        print(repaired, "51mers were joined by sequence because their ID did not match")
+
+    class_sequences = class_sequences.rename(columns={'51mer ID': 'join ID'})
+    merged_peptide_51mer = pd.merge(peptides, class_sequences, on='join ID', how='left')
+    merged_peptide_51mer = merged_peptide_51mer.drop(columns=['join ID'])
+
+    # Check the ID based join, every best peptide should be part of its 51mer
+    for column in ['Best Peptide Class I', 'Best Peptide Class II']:
+        inconsistent = ~np.array(contained(merged_peptide_51mer[column], merged_peptide_51mer[sequence_column]), dtype=bool)
+        if inconsistent.any():
+            print(column, "is not in the 51mer sequence of", list(merged_peptide_51mer['full ID'][inconsistent]))
+    merged_peptide_51mer = widen_columns(merged_peptide_51mer)
     
-    merged_peptide_51mer['sorting id'] = merged_peptide_51mer['full ID'].apply(extract_info) # creating a ID to sort reviewed canidates by the order of the 51mer
-    merged_peptide_51mer = make_column_unique(merged_peptide_51mer, 'sorting id') # make sure every sorting id is unique
+    merged_peptide_51mer['sorting id'] = make_unique(merged_peptide_51mer['sorting id']) # make sure every sorting id is unique
 
     # Sorting Candidates sheet to be in the same order as Peptides Sheet -------------------------
     reviewed_candidates = reviewed_candidates.set_index('sorting id')
@@ -281,14 +218,19 @@ def main():
     else:
         Peptide_file_name =  args.samp + "_Peptides_51-mer.xlsx"
 
-    merged_peptide_51mer.to_excel(Peptide_file_name, index=False)
+    write_review_workbook(merged_peptide_51mer, Peptide_file_name)
+    # columnar copy of the Peptides 51-mer read by color_peptides51mer and bold_classII
+    write_sidecar(merged_peptide_51mer, Peptide_file_name)
 
     if args.o:
         neoantigen_canidates_file_name = args.o +  "/" + args.samp + ".Annotated.Neoantigen_Candidates.xlsx"
     else:
         neoantigen_canidates_file_name =  args.samp + ".Annotated.Neoantigen_Candidates.xlsx"
 
-    reviewed_candidates.to_excel(neoantigen_canidates_file_name, index=False)
+    write_review_workbook(reviewed_candidates, neoantigen_canidates_file_name)
+
+    # the Peptides 51-mer table, setup_review.py hands it to color_peptides51mer
+    return merged_peptide_51mer
 
 
 if __name__ == "__main__":
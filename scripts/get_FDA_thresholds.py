@@ -20,7 +20,7 @@ Date: August 2023
 # Parses command line arguments
 # Enables user help
 # Future impovements: require the user to enter either the WB OR the list of files
-def parse_arguments():
+def parse_arguments(argv=None):
     # Parse command line arugments
     parser = argparse.ArgumentParser(description='Get FDA qc stats from various files and determine if they pass or fail.')
 
@@ -41,7 +41,7 @@ def parse_arguments():
     parser.add_argument("--contam_n", help="file path for VerifyBamID results for contamination the normal sample")
     parser.add_argument("--contam_t", help="file path for VerifyBamID results for contamination the tumor dna sample")
 
-    return(parser.parse_args())
+    return(parser.parse_args(argv))
 
 
 # ---- RESHAPE QUALITY THRESHOLDS --------------------------------------------
@@ -302,9 +302,10 @@ def evaluate_thresholds(qc):
     
 
 
-def main():
+def main(args=None):
 
-    args = parse_arguments()
+    if args is None:
+        args = parse_arguments()
 
 
     #sys.exit("Not a known trial\n")
@@ -392,8 +393,6 @@ def main():
 
     qc = qc.sort_values('Criteria', ignore_index=True)
     
-    pd.options.display.float_format = '{:.3f}'.format
-    
     # First identify the TOTAL_READS rows
     total_reads_mask = qc['Criteria'] == 'TOTAL_READS'
 
@@ -407,7 +406,9 @@ def main():
         qc.to_csv('fda_quality_thresholds_report.tsv', sep="\t", index=False)
     
 
-    print(qc)
+    # only for the printout, the display options are shared with the other stages of setup_review.py
+    with pd.option_context('display.float_format', '{:.3f}'.format):
+        print(qc)
 
 
 
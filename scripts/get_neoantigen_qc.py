@@ -12,7 +12,7 @@ Date: August 2023
 """
 
 # ---- PARSE ARGUMENTS -------------------------------------------------------
-def parse_arguments():
+def parse_arguments(argv=None):
     """Parses command line arguments and enables user help."""
     parser = argparse.ArgumentParser(description='Get the stats for the basic data QC review in the neoantigen final report.')
 
@@ -29,7 +29,7 @@ def parse_arguments():
     parser.add_argument("--yaml", help="File path for the pipeline YAML file", required=True)
     parser.add_argument("--fin_variants", help="File path for the final variants file")
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 # ---- EVALUATION FUNCTIONS --------------------------------------------------
@@ -235,8 +235,9 @@ def get_variant_count(final_variants):
         print(f"File {final_variants} not found.")
         return ""
 
-def main():
-    args = parse_arguments()
+def main(args=None):
+    if args is None:
+        args = parse_arguments()
 
     final_result = f"/{args.fin_results}" if args.fin_results else '/final_results'
 
@@ -256,7 +257,7 @@ def main():
     final_variants = args.fin_variants if args.fin_variants else f"{args.WB}{final_result}/variants.final.annotated.tsv"
         
     # create a text file to store results
-    qc_file = open(args.WB + '/../manual_review/qc_file.txt', 'w') if args.WB else pen('qc_file.txt', 'w')
+    qc_file = open(args.WB + '/../manual_review/qc_file.txt', 'w') if args.WB else open('qc_file.txt', 'w')
        
 
     print()
@@ -269,6 +270,7 @@ def main():
     qc_file.write(check_strand(strandness_check,  yaml_file))
     qc_file.write(get_variant_count(final_variants))
     qc_file.write("REMEMBER to visually inspect end bias plot (usually found in qc/tumor_rna/rna_metrics.pdf)")
+    qc_file.close()
 
     print()
     print("REMEMBER to visually inspect end bias plot (usually found in qc/tumor_rna/rna_metrics.pdf)")
@@ -6,7 +6,7 @@ import os.path
 # python3 scripts/hla_comparison.py -WB "/Users/evelynschmidt/Bioinformatics_tools/neoag_vaccine_scripts/test_data/gcp_immuno"
 
 # ---- PARSE ARGUMENTS -------------------------------------------------------
-def parse_arguments():
+def parse_arguments(argv=None):
     """Parses command line arguments and enables user help."""
     parser = argparse.ArgumentParser(description='Compare HLA alleles called by phlat, opitype, and clincal data if available.')
 
@@ -19,7 +19,7 @@ def parse_arguments():
     parser.add_argument("--clinical", help="File path for the clinical_calls.txt")
     parser.add_argument("--o", help="Output folder")
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 # A function that processes the phlat calls
@@ -180,8 +180,9 @@ def sort_hla_pairs(df):
         return sorted_df
 
         
-def main():
-    args = parse_arguments()
+def main(args=None):
+    if args is None:
+        args = parse_arguments()
     
     if args.WB:
         hla_typing = f"{args.WB}/{args.fin_results}/hla_typing"  
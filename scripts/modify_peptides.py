@@ -1,10 +1,15 @@
 import argparse
-from itertools import product, chain
+import csv
+from itertools import product, chain, islice
 import pandas as pd
 import sys
 import os
 import re
 import subprocess
+from peptide_ids import make_unique
+from peptide_metrics import manufacturability_metrics, MANUFACTURABILITY_COLUMNS
+from pvacbind_scheduler import run_pvacbind, DEFAULT_COMMAND
+from pvacbind_results import aggregate_results
 
 
 
@@ -25,52 +30,160 @@ def parse_arguments():
                         help='a list of the HLA alleles in the format: HLA-A*02:01,HLA-A*24:02,HLA-B*07:02,HLA-B*35:02,HLA-C*04:01,HLA-C*07:02')
     parser.add_argument('-WD',
                         help='The directory in which you would like to run pVACbind')
+    parser.add_argument('-lengths', default='8,9,10,11',
+                        help='Comma separated peptide lengths to create the sub-peptide fastas for (default: 8,9,10,11)')
+    parser.add_argument('-termini', default='n-term,c-term',
+                        help='Comma separated termini to create the sub-peptide fastas for (default: n-term,c-term)')
+    parser.add_argument('-all_subpeptides', action='store_true',
+                        help='Write every sub-peptide instead of only the unique sub-peptides of each length')
+    parser.add_argument('-run_pvacbind', action='store_true',
+                        help='Run pVACbind on the sub-peptide fastas, see pvacbind_scheduler.py for more options')
+    parser.add_argument('-jobs', type=int, default=os.cpu_count(),
+                        help='The number of pVACbind jobs to run at the same time (default: number of CPUs)')
+    parser.add_argument('-pvacbind_command', default=DEFAULT_COMMAND,
+                        help='The command template run for every pVACbind job (default: "' + DEFAULT_COMMAND + '")')
     
-    return(parser.parse_args())
+    args = parser.parse_args()
 
-def generate_modifed_peptides(n, name, base_sequence):
-    characters = ['K', 'R']
-    
-    # Generate all possible combinations up to length n
-    all_combinations = chain.from_iterable(product(characters, repeat=i) for i in range(1, n+1))
-
-    possible_modifications = set(''.join(combination) for combination in all_combinations)
-    
-    peptide_table = []
-
-    for modification in possible_modifications:
-
-        Nterm_dict = {}
-        Cterm_dict = {}
-
-        Nterm_sequence_name = name + "." + "n-term" + "-" + modification
-        Cterm_sequence_name = name + "." + "c-term" + "-" + modification
-
-        Nterm_sequence = modification + base_sequence
-        Cterm_sequence = base_sequence + modification 
+    # pVACbind runs after every fasta is written, so its arguments are checked up front
+    if args.run_pvacbind:
+        missing = [flag for flag, value in [('-HLA', args.HLA), ('-samp', args.samp)] if not value]
+        if missing:
+            parser.error(f"-run_pvacbind requires {' and '.join(missing)}")
 
-        Nterm_parsed_sequence = modification + '|' + base_sequence
-        Cterm_parsed_sequence = base_sequence + '|' + modification
+    return(args)
 
-        Nterm_dict.update({'sequence_name': Nterm_sequence_name, 'sequence': Nterm_sequence, 'parsed_sequence': Nterm_parsed_sequence})
-        Cterm_dict.update({'sequence_name': Cterm_sequence_name, 'sequence': Cterm_sequence, 'parsed_sequence': Cterm_parsed_sequence})
-
-        peptide_table.append(Nterm_dict)
-        peptide_table.append(Cterm_dict)
-
-    return(peptide_table)
-
-
-def assign_unique_numbers(df, column_name):
-    counts = df[column_name].value_counts()
-    duplicated_values = counts[counts > 1].index
-
-    for value in duplicated_values:
-        indices = df.index[df[column_name] == value]
-        for i, index in enumerate(indices, start=1):
-            df.at[index, column_name] = f"{value}.{i}"
+def generate_modifed_peptides(n, name, base_sequence):
+    # Yields every K/R modification of length 1 to n once, first added to the n-term and then to the c-term
+    characters = ['K', 'R']
 
-    return df
+    for length in range(1, n+1):
+        for combination in product(characters, repeat=length):
+            modification = ''.join(combination)
+
+            yield {'sequence_name': name + "." + "n-term" + "-" + modification,
+                   'sequence': modification + base_sequence,
+                   'parsed_sequence': modification + '|' + base_sequence,
+                   'terminus': 'n-term'}
+
+            yield {'sequence_name': name + "." + "c-term" + "-" + modification,
+                   'sequence': base_sequence + modification,
+                   'parsed_sequence': base_sequence + '|' + modification,
+                   'terminus': 'c-term'}
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def write_modified_peptides(modified_peptides, batch_size=20000):
+    # Streams the modified peptides to the peptide table, the fasta, the n-term and c-term fastas and
+    # the manufacturability table at the same time. Only one batch is held in memory.
+    counts = {'n-term': 0, 'c-term': 0}
+
+    with open('peptide_table.tsv', 'w', newline='') as table_file, \
+            open('modified_peptides.fa', 'w') as fasta_file, \
+            open('n-term/modified_peptides_n-term.fa', 'w') as n_term_file, \
+            open('c-term/modified_peptides_c-term.fa', 'w') as c_term_file, \
+            open('modified_peptides.fa.manufacturability.tsv', 'w') as manufacturability_file:
+
+        peptide_table = csv.writer(table_file, delimiter="\t", lineterminator="\n")
+        terminus_files = {'n-term': n_term_file, 'c-term': c_term_file}
+        header = True
+
+        for batch in batches(modified_peptides, batch_size):
+            for peptide in batch:
+                peptide_table.writerow([peptide['sequence_name'], peptide['sequence'], peptide['parsed_sequence']])
+
+                fasta_entry = f">{peptide['sequence_name']}\n{peptide['parsed_sequence']}\n"
+                fasta_file.write(fasta_entry)
+                terminus_files[peptide['terminus']].write(fasta_entry)
+                counts[peptide['terminus']] += 1
+
+            # Manufacturability of the modified peptides, in the format of the *.fa.manufacturability.tsv files
+            manufacturability = pd.DataFrame({'id': [peptide['sequence_name'] for peptide in batch],
+                                              'peptide_sequence': [peptide['sequence'] for peptide in batch]})
+            manufacturability = pd.concat([manufacturability, manufacturability_metrics(manufacturability['peptide_sequence'])], axis=1)
+            manufacturability.to_csv(manufacturability_file, sep="\t", index=False, header=header)
+            header = False
+
+        if header:
+            pd.DataFrame(columns=['id', 'peptide_sequence'] + MANUFACTURABILITY_COLUMNS).to_csv(manufacturability_file, sep="\t", index=False)
+
+    return counts
+
+
+# Sub-peptides contain the modification and LENGTH - 1 residues of the base sequence next to it
+# so each one tests at least one modified residue
+PARSED_SEQUENCE = re.compile(r'(\w+)\|(\w+)')
+
+def subpeptide(before, after, terminus, length):
+    if terminus == 'n-term':
+        return before + after[:length - 1]
+    return before[-(length - 1):] + after
+
+def junctional_windows(before, after, terminus, length):
+    # The LENGTH-mers pVACbind predicts for a sub-peptide, every one contains at least one added residue
+    sequence = subpeptide(before, after, terminus, length)
+    added = len(before) if terminus == 'n-term' else len(after)
+    return [sequence[i:i + length] for i in range(min(added, len(sequence) - length + 1))]
+
+def create_subpeptide_fastas(infile_path, input_dir, results_dir, terminus, lengths, unique=True, buffer_size=1 << 20):
+    # Reads the terminus fasta once and writes the {LENGTH}-mer-test.fa of every length at the same time.
+    # With unique=True every distinct junctional LENGTH-mer is written once, named by its sequence, and
+    # {LENGTH}-mer-test.mapping.tsv maps it to every modified peptide that contains it, so the predictions
+    # can be joined back to all of them. The windows of different modifications of a peptide overlap,
+    # e.g. K + base[:7] is a window of both the K and the KK modification.
+    length_fastas = {}
+    mappings = {}
+    tested = {length: set() for length in lengths}
+    windows = dict.fromkeys(lengths, 0)
+    total = 0
+
+    for length in lengths:
+        print(f"Creating input fasta to test peptides of length: {length}")
+        os.makedirs(os.path.join(results_dir, f"{length}-mer-test"), exist_ok=True)
+        length_fastas[length] = open(os.path.join(input_dir, f"{length}-mer-test.fa"), 'w', buffering=buffer_size)
+        if unique:
+            mappings[length] = open(os.path.join(input_dir, f"{length}-mer-test.mapping.tsv"), 'w', buffering=buffer_size)
+            mappings[length].write("sequence_name\ttested_as\n")
+
+    try:
+        with open(infile_path, 'r', buffering=buffer_size) as infile:
+            sequence_name = None
+            for line in infile:
+                line = line.strip()
+                if line.startswith('>'):
+                    sequence_name = line[1:]
+                    if not unique:
+                        for length_fasta in length_fastas.values():
+                            length_fasta.write(f"{line}\n")
+                elif match := PARSED_SEQUENCE.match(line):
+                    before, after = match.groups()
+                    total += 1
+                    for length, length_fasta in length_fastas.items():
+                        if not unique:
+                            length_fasta.write(f"{subpeptide(before, after, terminus, length)}\n")
+                            continue
+
+                        peptide_windows = junctional_windows(before, after, terminus, length)
+                        windows[length] += len(peptide_windows)
+                        # a window repeated inside one sub-peptide is mapped to it once
+                        for window in dict.fromkeys(peptide_windows):
+                            if window not in tested[length]:
+                                tested[length].add(window)
+                                length_fasta.write(f">{window}\n{window}\n")
+                            mappings[length].write(f"{sequence_name}\t{window}\n")
+    finally:
+        for output_file in chain(length_fastas.values(), mappings.values()):
+            output_file.close()
+
+    if unique:
+        for length in lengths:
+            print(f"{length}-mer: {len(tested[length])} unique of {windows[length]} junctional windows in {total} sub-peptides")
 
 def main():
     args = parse_arguments()
@@ -79,168 +192,54 @@ def main():
 
     peptides = pd.read_csv(args.m, names=["Name", "Sequence"], header=None)
     peptides = peptides[1:]
-    peptides = assign_unique_numbers(peptides, "Name")
+    peptides["Name"] = make_unique(peptides["Name"], number_first=True)
 
-    # max_length = 3
-    list = []
-
-    for index, row in peptides.iterrows():
-        sequences_list = []
-        
-        name = row['Name']
-        base_sequence = row['Sequence']
-        sequences_list  = generate_modifed_peptides(max_length, name, base_sequence)
-
-        list = list + sequences_list
-
-    peptide_table = pd.DataFrame(list) 
-
-    peptide_table.to_csv('peptide_table.tsv', sep="\t", index=False, header=None)
-
-
-    # Perform checks
-    num_entries = len(peptide_table)
-
-    # Check if all entries in the sequence_name column are unique
-    are_all_unique = not peptide_table['sequence_name'].duplicated().any()
-
-    if are_all_unique:
+    # The names are unique and every modification is generated once, so every sequence_name is unique
+    if not peptides['Name'].duplicated().any():
         print("All entries in the sequence_name column are unique.")
     else:
         print("There are duplicate entries in the sequence_name column.")
         sys.exit(1)
-    
-    with open('modified_peptides.fa', 'w') as fasta_file:
-        for index, row in peptide_table.iterrows():
-            sequence_name = ">" + row['sequence_name']
-            sequence = row['parsed_sequence']
-            fasta_file.write(f"{sequence_name}\n{sequence}\n")
-
 
     # Create dirs for processing the N-term and C-term sequences separately
     os.makedirs("n-term", exist_ok=True)
     os.makedirs("c-term", exist_ok=True)
 
-    with open('modified_peptides.fa', 'r') as input_file, \
-            open('n-term/modified_peptides_n-term.fa', 'w') as n_term_file, \
-            open('c-term/modified_peptides_c-term.fa', 'w') as c_term_file:
-        
-        for line in input_file:
-            line = line.strip()
-            
-            # Check for the pattern 'n-term' in the line
-            if 'n-term' in line:
-                n_term_file.write(line + '\n')
-                
-                # Ensure there are at least two more lines in the file
-                try:
-                    next_line = next(input_file).strip()
-                    n_term_file.write(next_line + '\n')
-                except StopIteration:
-                    # Handle the case where there are not enough lines left
-                    pass
-            
-            # Check for the pattern 'c-term' in the line
-            if 'c-term' in line:
-                c_term_file.write(line + '\n')
-                
-                # Ensure there are at least two more lines in the file
-                try:
-                    next_line = next(input_file).strip()
-                    c_term_file.write(next_line + '\n')
-                except StopIteration:
-                    # Handle the case where there are not enough lines left
-                    pass
-
-    def get_line_count(file_path):
-        with open(file_path, 'r') as file:
-            return sum(1 for line in file)
-
-    modified_peptides_count = get_line_count('modified_peptides.fa')
-    n_term_count = get_line_count('n-term/modified_peptides_n-term.fa')
-    c_term_count = get_line_count('c-term/modified_peptides_c-term.fa')
-
-    if n_term_count+ c_term_count == modified_peptides_count:
-        print("Sucessfully split fasta into n-term and c-term")
-    else:
-        print("N-term and c-term fasta lines to not equal modified fasta lines")
-
-
-    def  create_subpeptide_fastas_n_term(input_dir, results_dir, infile_path):
-        # Define the lengths to iterate over
-        lengths = [8, 9, 10, 11]
-
-        # Iterate over each test length
-        for LENGTH in lengths:
-            # Create input files for each test length
-            print(f"Creating input fasta to test peptides of length: {LENGTH}")
-            
-            # Set the file paths
-            LENGTH_FASTA = os.path.join(input_dir , f"{LENGTH}-mer-test.fa")
-            LENGTH_RESULT_DIR = os.path.join(results_dir, f"{LENGTH}-mer-test")
-            
-            # Create the result directory if it doesn't exist
-            os.makedirs(LENGTH_RESULT_DIR, exist_ok=True)
-            
-            with open(infile_path, 'r') as infile, open(LENGTH_FASTA, 'w') as length_fasta:
-                for line in infile:
-                    line = line.strip()
-                    if line.startswith('>'):
-                        length_fasta.write(f"{line}\n")
-                    elif match := re.match(r'(\w+)\|(\w+)', line):
-                        before, after = match.groups()
-                        sub = after[:LENGTH - 1]
-                        length_fasta.write(f"{before}{sub}\n")
-                infile.close()
-
-    def  create_subpeptide_fastas_c_term(input_dir, results_dir, infile_path):
-        # Define the lengths to iterate over
-        lengths = [8, 9, 10, 11]
-
-        for LENGTH in lengths:
-            # Create input files for each test length so that each test sequence will contain at least one modified base
-            print(f"Creating input fasta to test peptides of length: {LENGTH}")
-
-            LENGTH_FASTA = os.path.join(input_dir, f"{LENGTH}-mer-test.fa")
-            LENGTH_RESULT_DIR = os.path.join(results_dir, f"{LENGTH}-mer-test")
-
-            os.makedirs(LENGTH_RESULT_DIR, exist_ok=True)
-
-            with open(infile_path, 'r') as infile, open(LENGTH_FASTA, 'w') as length_fasta:
-                for line in infile:
-                    line = line.strip()
-                    if line.startswith('>'):
-                        length_fasta.write(f"{line}\n")
-                    elif match := re.match(r'(\w+)\|(\w+)', line):
-                        before, after = match.groups()
-                        sub = before[-(LENGTH - 1):]
-                        length_fasta.write(f"{sub}{after}\n")
-                infile.close()
+    modified_peptides = chain.from_iterable(generate_modifed_peptides(max_length, name, base_sequence)
+                                            for name, base_sequence in zip(peptides['Name'], peptides['Sequence']))
+    counts = write_modified_peptides(modified_peptides)
 
-    # Set up sub-peptide fasta sequences for each target class I prediction length
-    working_dir = args.WD
+    print("Sucessfully split fasta into", counts['n-term'], "n-term and", counts['c-term'], "c-term peptides")
 
-    input_dir = os.path.join(working_dir + "/n-term/pvacbind_inputs")
-    results_dir = os.path.join(working_dir + "/n-term/pvacbind_results")
-    infile_path = os.path.join(working_dir + "/n-term/modified_peptides_n-term.fa")
 
-    os.makedirs(input_dir, exist_ok=True)
-    os.makedirs(results_dir, exist_ok=True)
+    # Set up sub-peptide fasta sequences for each target class I prediction length
+    working_dir = args.WD
+    lengths = [int(length) for length in args.lengths.split(',')]
 
-    print("Creating sub-pepetide fastas for n-term")
-    create_subpeptide_fastas_n_term(input_dir, results_dir, infile_path)
+    for terminus in args.termini.split(','):
+        if terminus not in ['n-term', 'c-term']:
+            print("Unknown terminus", terminus, "use n-term or c-term")
+            sys.exit(1)
 
-    input_dir = os.path.join(working_dir + "/c-term/pvacbind_inputs")
-    results_dir = os.path.join(working_dir + "/c-term/pvacbind_results")
-    infile_path = os.path.join(working_dir + "/c-term/modified_peptides_c-term.fa")
+        input_dir = os.path.join(working_dir + "/" + terminus + "/pvacbind_inputs")
+        results_dir = os.path.join(working_dir + "/" + terminus + "/pvacbind_results")
+        infile_path = os.path.join(working_dir + "/" + terminus + "/modified_peptides_" + terminus + ".fa")
 
-    os.makedirs(input_dir, exist_ok=True)
-    os.makedirs(results_dir, exist_ok=True)
+        os.makedirs(input_dir, exist_ok=True)
+        os.makedirs(results_dir, exist_ok=True)
 
-    print("Creating sub-pepetide fastas for c-term")
-    create_subpeptide_fastas_c_term(input_dir, results_dir, infile_path)
+        print("Creating sub-pepetide fastas for " + terminus)
+        create_subpeptide_fastas(infile_path, input_dir, results_dir, terminus, lengths, unique=not args.all_subpeptides)
 
     # Run pVACtools
+    if args.run_pvacbind:
+        succeeded = run_pvacbind(working_dir, args.samp, args.HLA.split(','), args.termini.split(','), lengths,
+                                 max_workers=args.jobs, command=args.pvacbind_command)
+        if not succeeded:
+            sys.exit(1)
+
+        # Rank the modifications of every peptide by the junctional binders they create
+        aggregate_results(working_dir, args.termini.split(','), lengths, os.path.join(working_dir, "modified_peptides.ranked.tsv"))
 
 
 
@@ -0,0 +1,141 @@
+import re
+import numpy as np
+import pandas as pd
+
+'''
+Shared handling of the peptide and 51mer IDs used by generate_reviews_files
+and modify_peptides.
+'''
+
+
+# ---- UNIQUE IDS ------------------------------------------------------------
+# Appends .1, .2, ... to repeated values so every value in the column is unique.
+# With number_first=False the first occurrence keeps its value (A, A.1, A.2),
+# with number_first=True every occurrence of a repeated value is numbered (A.1, A.2, A.3).
+# A generated value that is already in the column is bumped to the next free suffix.
+# Missing values are left as they are.
+def make_unique(values, number_first=False):
+    values = pd.Series(values)
+    unique_values = values.astype(object).copy()
+
+    present = values[values.notna()]
+    occurrence = present.groupby(present, sort=False).cumcount()
+    group_size = present.groupby(present, sort=False).transform('size')
+
+    if number_first:
+        numbered = group_size > 1
+        suffix = occurrence + 1
+    else:
+        numbered = occurrence > 0
+        suffix = occurrence
+
+    base = present[numbered].astype(str)
+    suffix = suffix[numbered]
+    unique_values[numbered.index[numbered]] = base + '.' + suffix.astype(str)
+
+    # Only a generated value can collide, with a value that is kept as it is
+    kept = set(present[~numbered])
+    collided = np.flatnonzero(unique_values[base.index].isin(kept).to_numpy())
+
+    if len(collided) > 0:
+        used = set(unique_values[values.notna()])
+        for position in collided:
+            index = base.index[position]
+            next_suffix = suffix.iloc[position]
+            while f"{base.iloc[position]}.{next_suffix}" in used:
+                next_suffix += 1
+            unique_values[index] = f"{base.iloc[position]}.{next_suffix}"
+            used.add(unique_values[index])
+
+    return unique_values
+
+
+# ---- 51MER IDS -------------------------------------------------------------
+# A 51mer ID looks like MT.239.KIF7.ENST00000394412.8.FS.405-410CGCGCACTCGGCGCCCAG/C,
+# a pVACseq Index is the same ID without the MT prefix. The fields are taken from
+# the right so gene names that contain a period are parsed correctly.
+ID_PATTERN = re.compile(r'^(?:(?P<prefix>[A-Za-z]+)\.)?(?P<number>\d+)\.(?P<gene>.+)\.'
+                        r'(?P<transcript>[^.]+)\.(?P<version>\d+)\.(?P<variant_type>[^.]+)\.(?P<change>[^.]+)$')
+
+# The change is the protein position followed by the reference and alternate amino acids, e.g. 585-589KTGV*/R
+CHANGE_PATTERN = re.compile(r'^(?P<position>[\d-]*)(?P<ref>[^/]*)/?(?P<alt>.*)$')
+
+# AA Change column of the aggregated reports, e.g. G518D
+AA_CHANGE_PATTERN = re.compile(r'^(?P<ref>[A-Za-z]+)(?P<position>[\d-]+)(?P<alt>[A-Za-z]*)')
+
+
+def parse_ids(ids):
+    # Returns one row per ID with the columns prefix, number, gene, transcript, version,
+    # variant_type, change, position, ref and alt, and the ID itself. Fields of IDs that do not parse are NaN.
+    ids = pd.Series(ids).astype(object)
+    records = ids.str.extract(ID_PATTERN)
+    records = records.join(records['change'].str.extract(CHANGE_PATTERN))
+    records['id'] = ids
+
+    unparsed = ids.notna() & records['gene'].isna()
+    if unparsed.any():
+        print("IDs not in the expected format:", list(ids[unparsed]))
+
+    return records
+
+def join_fields(*fields):
+    key = fields[0]
+    for field in fields[1:]:
+        key = key + '.' + field
+    return key
+
+def id_key(records, *fields):
+    # IDs that did not parse are used as their own key so they never match another row
+    return join_fields(*fields).fillna(records['id'])
+
+def candidate_names(records):
+    # MT.239.KIF7
+    return id_key(records, records['prefix'], records['number'], records['gene'])
+
+def transcript_keys(records):
+    # KIF7.ENST00000394412.8, matches Gene.Best Transcript of the reviewed candidates
+    return id_key(records, records['gene'], records['transcript'], records['version'])
+
+def variant_keys(records):
+    # The key matched to Gene.Best Transcript.AA Change of the class I report (see aa_change_keys)
+    #   missense     ZP2.ENST00000574002.1.84D/Y
+    #   FS           KIF7.ENST00000394412.8.FS405-410
+    #   inframe_del  DNAAF3.ENST00000391720.8.KTGV*585-589R
+    #   inframe_ins  ZCCHC14.ENST00000268616.9.769H/HH
+    change = records['change']
+    variant_type = records['variant_type']
+
+    # Frame shifts only keep the positions, a / is kept when a digit follows the first one
+    frame_shift = change.str.replace(r'[^\d/-]', '', regex=True)
+    frame_shift = frame_shift.where(change.str.contains(r'^[^/]*/\d', na=False),
+                                    frame_shift.str.replace('/', '', regex=False))
+    deletion = records['ref'] + records['position'] + records['alt'].str.split('/').str[0]
+
+    tail = change.copy()
+    tail[variant_type == 'FS'] = 'FS' + frame_shift
+    tail[variant_type == 'inframe_del'] = deletion
+
+    other = records['gene'].notna() & ~variant_type.isin(['missense', 'FS', 'inframe_del', 'inframe_ins'])
+    if other.any():
+        print("Non missense candidates not accounted for:", list(variant_type[other].unique()))
+
+    return id_key(records, records['gene'], records['transcript'], records['version'], tail)
+
+def position_keys(records):
+    # ZP2.ENST00000574002.1.84, the key used by bold_classII
+    keys = join_fields(records['gene'], records['transcript'], records['version'], records['change'])
+    return keys.str.replace(r'\D+$', '', regex=True).fillna(records['id'])
+
+def aa_change_keys(genes, transcripts, aa_changes, position_only=False):
+    # Gene.Best Transcript.AA Change with G518D written as 518G/D, or as 518 with position_only.
+    # AA Changes in another format (e.g. FS or KTGV*538-542R) are used as they are.
+    aa_changes = pd.Series(aa_changes).astype(object)
+    parts = aa_changes.str.extract(AA_CHANGE_PATTERN)
+
+    if position_only:
+        rearranged = parts['position'].where(parts['position'].notna(), aa_changes)
+    else:
+        rearranged = parts['position'] + parts['ref'] + '/' + parts['alt']
+        rearranged = rearranged.where(parts['alt'].fillna('') != '', aa_changes)
+
+    return join_fields(pd.Series(genes).astype(object), pd.Series(transcripts).astype(object), rearranged)
@@ -0,0 +1,163 @@
+import sys
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from Bio.Data.IUPACData import protein_weights
+
+'''
+Batch peptide metrics computed with NumPy over sequences encoded as uint8 arrays.
+
+molecular_weights() gives the same values as Biopython's
+ProteinAnalysis(peptide).molecular_weight() (average masses) for a whole column
+of peptides at once. Repeated sequences are only computed once.
+
+manufacturability_metrics() computes the manufacturability columns of the
+*.fa.manufacturability.tsv files (the vaxrank definitions) for a whole column of
+peptides, so they can be recomputed for modified peptides.
+
+Example:
+peptides["MW"] = molecular_weights(peptides["peptide_sequence"])
+metrics = manufacturability_metrics(peptides["peptide_sequence"])
+'''
+
+# Water lost per peptide bond, the value Biopython uses for average masses
+WATER = 18.0153
+
+# Residue mass indexed by the ASCII code of the amino acid, NaN for invalid letters
+# and 0 for the padding used by encode_sequences
+RESIDUE_MASSES = np.full(256, np.nan)
+for amino_acid, weight in protein_weights.items():
+    RESIDUE_MASSES[ord(amino_acid)] = weight
+RESIDUE_MASSES[0] = 0.0
+
+# Kyte-Doolittle hydropathy indexed the same way
+KYTE_DOOLITTLE = {'A': 1.8, 'R': -4.5, 'N': -3.5, 'D': -3.5, 'C': 2.5, 'Q': -3.5, 'E': -3.5,
+                  'G': -0.4, 'H': -3.2, 'I': 4.5, 'L': 3.8, 'K': -3.9, 'M': 1.9, 'F': 2.8,
+                  'P': -1.6, 'S': -0.8, 'T': -0.7, 'W': -0.9, 'Y': -1.3, 'V': 4.2}
+HYDROPATHY = np.full(256, np.nan)
+for amino_acid, hydropathy in KYTE_DOOLITTLE.items():
+    HYDROPATHY[ord(amino_acid)] = hydropathy
+HYDROPATHY[0] = 0.0
+
+# Window used for the gravy scores
+GRAVY_WINDOW = 7
+
+# Columns in the order of the *.fa.manufacturability.tsv files
+MANUFACTURABILITY_COLUMNS = ['cterm_7mer_gravy_score', 'max_7mer_gravy_score', 'difficult_n_terminal_residue',
+                             'c_terminal_cysteine', 'c_terminal_proline', 'cysteine_count',
+                             'n_terminal_asparagine', 'asparagine_proline_bond_count']
+
+
+def encode_sequences(sequences):
+    # Returns a uint8 matrix with one upper case sequence per row padded with 0, and the lengths
+    sequences = [sequence.upper() for sequence in sequences]
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+
+    matrix = np.zeros((len(sequences), lengths.max() if len(sequences) > 0 else 0), dtype=np.uint8)
+    residues = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8)
+    matrix[np.arange(matrix.shape[1]) < lengths[:, None]] = residues
+
+    return matrix, lengths
+
+def sum_columns(columns, shape):
+    # Adds the columns up left to right the same way Python's sum() adds the values of a row so the totals
+    # match Biopython and vaxrank to the last bit. From Python 3.12 on sum() uses Neumaier compensated summation.
+    compensated = sys.version_info >= (3, 12)
+    totals = np.zeros(shape)
+    compensation = np.zeros(shape)
+    for column in columns:
+        new_totals = totals + column
+        if compensated:
+            compensation += np.where(np.abs(totals) >= np.abs(column),
+                                     (totals - new_totals) + column,
+                                     (column - new_totals) + totals)
+        totals = new_totals
+    return totals + compensation
+
+def sum_rows(masses):
+    return sum_columns(masses.T, len(masses))
+
+def unique_molecular_weights(sequences):
+    matrix, lengths = encode_sequences(sequences)
+    masses = RESIDUE_MASSES[matrix]
+
+    invalid = np.isnan(masses).any(axis=1)
+    if invalid.any():
+        raise ValueError(f"Invalid amino acid in peptide {sequences[np.flatnonzero(invalid)[0]]}")
+
+    return sum_rows(masses) - (lengths - 1) * WATER
+
+def molecular_weights(peptides):
+    # Molecular weight of every peptide in a Series, missing peptides get NaN
+    peptides = pd.Series(peptides)
+    weights = pd.Series(np.nan, index=peptides.index)
+
+    present = peptides.notna()
+    codes, unique_sequences = pd.factorize(peptides[present])
+    if len(unique_sequences) > 0:
+        weights[present] = unique_molecular_weights(list(unique_sequences))[codes]
+
+    return weights
+
+
+# ---- MANUFACTURABILITY -----------------------------------------------------
+def window_gravy_scores(hydropathy, lengths, k=GRAVY_WINDOW):
+    # Mean hydropathy of every k residue window, one column per window start. Windows are summed
+    # with shifted adds (a sliding convolution) in residue order, compensated like vaxrank's sum() on
+    # Python 3.12+. Windows that run past the end of a peptide are -inf. Peptides shorter than k get
+    # their whole mean in column 0.
+    n_windows = max(hydropathy.shape[1] - k + 1, 1)
+    padded = np.zeros((len(hydropathy), n_windows + k - 1))
+    padded[:, :hydropathy.shape[1]] = hydropathy
+
+    window_sums = sum_columns((padded[:, offset:offset + n_windows] for offset in range(k)), (len(hydropathy), n_windows))
+    scores = window_sums / k
+
+    scores[np.arange(n_windows) > (lengths - k)[:, None]] = -np.inf
+
+    short = lengths < k
+    if short.any():
+        scores[short, 0] = sum_rows(hydropathy[short]) / lengths[short]
+    return scores
+
+def unique_manufacturability_metrics(sequences):
+    matrix, lengths = encode_sequences(sequences)
+    hydropathy = HYDROPATHY[matrix]
+
+    invalid = np.isnan(hydropathy).any(axis=1)
+    if invalid.any():
+        raise ValueError(f"Invalid amino acid in peptide {sequences[np.flatnonzero(invalid)[0]]}")
+
+    scores = window_gravy_scores(hydropathy, lengths)
+    rows = np.arange(len(sequences))
+    first = matrix[:, 0]
+    last = matrix[rows, lengths - 1]
+
+    return pd.DataFrame({
+        'cterm_7mer_gravy_score': scores[rows, np.maximum(lengths - GRAVY_WINDOW, 0)],
+        'max_7mer_gravy_score': scores.max(axis=1),
+        'difficult_n_terminal_residue': np.isin(first, [ord('Q'), ord('E'), ord('C')]),
+        'c_terminal_cysteine': last == ord('C'),
+        'c_terminal_proline': last == ord('P'),
+        'cysteine_count': (matrix == ord('C')).sum(axis=1),
+        'n_terminal_asparagine': first == ord('N'),
+        'asparagine_proline_bond_count': ((matrix[:, :-1] == ord('N')) & (matrix[:, 1:] == ord('P'))).sum(axis=1),
+    }, columns=MANUFACTURABILITY_COLUMNS)
+
+def manufacturability_metrics(peptides):
+    # Manufacturability columns for every peptide in a Series, missing and empty peptides get NaN
+    peptides = pd.Series(peptides)
+
+    present = peptides.notna() & (peptides.astype(str) != '')
+    codes, unique_sequences = pd.factorize(peptides[present])
+    if len(unique_sequences) == 0:
+        return pd.DataFrame(index=peptides.index, columns=MANUFACTURABILITY_COLUMNS)
+
+    metrics = unique_manufacturability_metrics(list(unique_sequences)).iloc[codes]
+    metrics.index = peptides.index[present]
+    return metrics.reindex(peptides.index)
+
+@lru_cache(maxsize=None)
+def molecular_weight(peptide):
+    # Memoized single peptide version
+    return float(unique_molecular_weights([peptide])[0])
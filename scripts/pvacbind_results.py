@@ -0,0 +1,171 @@
+import argparse
+import glob
+import heapq
+import os
+import re
+import pandas as pd
+
+'''
+Reads the pVACbind results of the modified peptides back and ranks the K/R
+modifications of every base peptide. Every window that was tested contains at
+least one added residue, so every prediction is for a junctional peptide that the
+modification creates. The best modification is the one whose strongest junctional
+binder has the highest IC50, modifications with a junctional binder below
+-binding_threshold are flagged.
+
+The results files are streamed in chunks and only the strongest prediction of every
+tested window is kept, predictions are joined back to every modified peptide that
+contains the window through the {LENGTH}-mer-test.mapping.tsv files written by
+modify_peptides.py and a heap keeps the -top best modifications of every base
+peptide.
+
+Example Run:
+python3 /opt/scripts/pvacbind_results.py -WD $WORKING_DIR -o modified_peptides.ranked.tsv
+'''
+
+# The columns used from the pVACbind all_epitopes.tsv
+RESULT_COLUMNS = ['Mutation', 'HLA Allele', 'Epitope Seq', 'Median IC50 Score', 'Median Percentile']
+
+# sequence_name written by modify_peptides.py, e.g. KRAS.1.n-term-KR
+SEQUENCE_NAME = re.compile(r'^(?P<peptide>.*)\.(?P<terminus>n-term|c-term)-(?P<modification>[KR]+)$')
+
+
+# ---- PARSE ARGUMENTS -------------------------------------------------------
+# Parses command line arguments
+# Enables user help
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Rank the modified peptides by their junctional pVACbind predictions')
+
+    parser.add_argument('-WD',
+                        help='The directory modify_peptides.py and pVACbind were run in', required=True)
+    parser.add_argument('-lengths', default='8,9,10,11',
+                        help='Comma separated peptide lengths to read (default: 8,9,10,11)')
+    parser.add_argument('-termini', default='n-term,c-term',
+                        help='Comma separated termini to read (default: n-term,c-term)')
+    parser.add_argument('-top', type=int, default=5,
+                        help='The number of modifications reported per base peptide (default: 5)')
+    parser.add_argument('-binding_threshold', type=float, default=500,
+                        help='Junctional peptides with a median IC50 below this are flagged as binders (default: 500)')
+    parser.add_argument('-o', default='modified_peptides.ranked.tsv',
+                        help='The output tsv (default: modified_peptides.ranked.tsv)')
+
+    return(parser.parse_args())
+
+
+# ---- READ RESULTS ----------------------------------------------------------
+def result_files(working_dir, terminus, length):
+    # All epitope files of a length, allele batches are in their own directories
+    results_dir = os.path.join(working_dir, terminus, "pvacbind_results", f"{length}-mer-test")
+    return sorted(glob.glob(os.path.join(results_dir, "**", "*.all_epitopes.tsv"), recursive=True))
+
+def strongest_predictions(paths, chunksize=500000):
+    # Strongest prediction (lowest median IC50) of every tested sub-peptide, read chunk by chunk.
+    # Returns a dict of tested name -> (IC50, percentile, allele, epitope)
+    strongest = {}
+
+    for path in paths:
+        reader = pd.read_csv(path, sep="\t", usecols=RESULT_COLUMNS, chunksize=chunksize)
+        with reader:
+            for chunk in reader:
+                chunk = chunk.dropna(subset=['Median IC50 Score'])
+                chunk = chunk.sort_values('Median IC50 Score', kind='mergesort').drop_duplicates('Mutation')
+
+                for name, ic50, percentile, allele, epitope in zip(chunk['Mutation'], chunk['Median IC50 Score'],
+                                                                   chunk['Median Percentile'], chunk['HLA Allele'],
+                                                                   chunk['Epitope Seq']):
+                    if name not in strongest or ic50 < strongest[name][0]:
+                        strongest[name] = (ic50, percentile, allele, epitope)
+
+    return strongest
+
+def read_mapping(working_dir, terminus, length):
+    # Yields (sequence_name, tested_as) pairs, one for every junctional window a modified peptide contains.
+    # Without a mapping file every sub-peptide was tested as a whole under its own name.
+    path = os.path.join(working_dir, terminus, "pvacbind_inputs", f"{length}-mer-test.mapping.tsv")
+    if os.path.isfile(path):
+        with open(path) as mapping:
+            next(mapping)
+            for line in mapping:
+                sequence_name, tested_as = line.rstrip('\n').split('\t')
+                yield sequence_name, tested_as
+    else:
+        with open(os.path.join(working_dir, terminus, "pvacbind_inputs", f"{length}-mer-test.fa")) as fasta:
+            for line in fasta:
+                if line.startswith('>'):
+                    yield line[1:].strip(), line[1:].strip()
+
+def strongest_junctional_binders(working_dir, termini, lengths):
+    # Strongest junctional prediction of every modified peptide over all lengths and alleles. A window is
+    # predicted once and its prediction is fanned out to every modified peptide that contains it.
+    strongest = {}
+    missing = set()
+
+    for terminus in termini:
+        for length in lengths:
+            predictions = strongest_predictions(result_files(working_dir, terminus, length))
+
+            for sequence_name, tested_as in read_mapping(working_dir, terminus, length):
+                prediction = predictions.get(tested_as)
+                if prediction is None:
+                    missing.add((terminus, length, tested_as))
+                elif sequence_name not in strongest or prediction[0] < strongest[sequence_name][0]:
+                    strongest[sequence_name] = prediction
+
+    if missing:
+        print(len(missing), "tested windows have no predictions")
+    return strongest
+
+
+# ---- RANK ------------------------------------------------------------------
+def rank_modifications(strongest, top=5, binding_threshold=500):
+    # Keeps the top best modifications of every base peptide in a heap. A modification is better when its
+    # strongest junctional binder has a higher IC50, then when it adds fewer residues.
+    heaps = {}
+
+    for sequence_name, (ic50, percentile, allele, epitope) in strongest.items():
+        match = SEQUENCE_NAME.match(sequence_name)
+        if match is None:
+            print("Not a modified peptide name:", sequence_name)
+            continue
+
+        modification = match.group('modification')
+        # The heap keeps the worst kept modification on top
+        entry = ((ic50, -len(modification), sequence_name), match.group('terminus'), modification, percentile, allele, epitope)
+        heap = heaps.setdefault(match.group('peptide'), [])
+        if len(heap) < top:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+
+    rows = []
+    for peptide in sorted(heaps):
+        for rank, entry in enumerate(sorted(heaps[peptide], reverse=True), start=1):
+            (ic50, _, sequence_name), terminus, modification, percentile, allele, epitope = entry
+            rows.append({'peptide': peptide, 'rank': rank, 'sequence_name': sequence_name, 'terminus': terminus,
+                         'modification': modification, 'strongest junctional IC50': ic50,
+                         'strongest junctional percentile': percentile, 'HLA Allele': allele, 'Epitope Seq': epitope,
+                         'junctional binder': ic50 < binding_threshold})
+
+    return pd.DataFrame(rows, columns=['peptide', 'rank', 'sequence_name', 'terminus', 'modification',
+                                       'strongest junctional IC50', 'strongest junctional percentile',
+                                       'HLA Allele', 'Epitope Seq', 'junctional binder'])
+
+def aggregate_results(working_dir, termini, lengths, output, top=5, binding_threshold=500):
+    strongest = strongest_junctional_binders(working_dir, termini, lengths)
+    ranked = rank_modifications(strongest, top, binding_threshold)
+    ranked.to_csv(output, sep="\t", index=False)
+
+    print("Ranked", ranked['peptide'].nunique(), "peptides,", int(ranked['junctional binder'].sum()),
+          "of the reported modifications create a junctional binder")
+    return ranked
+
+
+def main():
+    args = parse_arguments()
+
+    aggregate_results(args.WD, args.termini.split(','), [int(length) for length in args.lengths.split(',')],
+                      args.o, args.top, args.binding_threshold)
+
+
+if __name__ == "__main__":
+    main()
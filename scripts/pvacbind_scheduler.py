@@ -0,0 +1,169 @@
+import argparse
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+'''
+Runs pVACbind on the sub-peptide fastas created by modify_peptides.py. One job is
+launched per terminus, peptide length and batch of alleles, at most -jobs at a time.
+Jobs whose output already exists are skipped, failed jobs are retried and the wall
+time of every job is written to pvacbind_jobs.tsv in the working directory.
+
+The command is a template so another program (e.g. a stub while testing) can be run
+instead of pvacbind. The fields {input_fasta}, {sample}, {alleles}, {algorithms},
+{output_dir}, {length} and {terminus} are filled in shell quoted, every algorithm
+as its own argument.
+
+Example Run:
+python3 /opt/scripts/pvacbind_scheduler.py -WD $WORKING_DIR -samp $PATIENT_ID -HLA HLA-A*02:01,HLA-B*07:02 -jobs 8
+'''
+
+DEFAULT_COMMAND = "pvacbind run {input_fasta} {sample} {alleles} {algorithms} {output_dir} -e1 {length} --n-threads 1"
+DEFAULT_OUTPUT = "{output_dir}/MHC_Class_I/{sample}.all_epitopes.tsv"
+
+
+# ---- PARSE ARGUMENTS -------------------------------------------------------
+# Parses command line arguments
+# Enables user help
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Run pVACbind on the modified peptide fastas in parallel')
+
+    parser.add_argument('-WD',
+                        help='The directory modify_peptides.py was run in', required=True)
+    parser.add_argument('-samp',
+                        help='sample name', required=True)
+    parser.add_argument('-HLA',
+                        help='a list of the HLA alleles in the format: HLA-A*02:01,HLA-A*24:02,HLA-B*07:02', required=True)
+    parser.add_argument('-lengths', default='8,9,10,11',
+                        help='Comma separated peptide lengths to run (default: 8,9,10,11)')
+    parser.add_argument('-termini', default='n-term,c-term',
+                        help='Comma separated termini to run (default: n-term,c-term)')
+    parser.add_argument('-algorithms', default='all_class_i',
+                        help='Space or comma separated prediction algorithms passed to pvacbind (default: all_class_i)')
+    parser.add_argument('-allele_batch', type=int, default=0,
+                        help='The number of alleles per job, 0 runs all alleles in one job (default: 0)')
+    parser.add_argument('-jobs', type=int, default=os.cpu_count(),
+                        help='The number of jobs to run at the same time (default: number of CPUs)')
+    parser.add_argument('-retries', type=int, default=1,
+                        help='How often a failed job is retried (default: 1)')
+    parser.add_argument('-command', default=DEFAULT_COMMAND,
+                        help='The command template run for every job (default: "' + DEFAULT_COMMAND + '")')
+    parser.add_argument('-output', default=DEFAULT_OUTPUT,
+                        help='The output a finished job leaves behind, jobs where it exists are skipped (default: "' + DEFAULT_OUTPUT + '")')
+
+    return(parser.parse_args())
+
+
+# ---- JOBS ------------------------------------------------------------------
+def allele_batches(alleles, batch_size):
+    if batch_size <= 0:
+        return [alleles]
+    return [alleles[i:i + batch_size] for i in range(0, len(alleles), batch_size)]
+
+def plan_jobs(working_dir, sample, alleles, termini, lengths, algorithms='all_class_i', batch_size=0,
+              command=DEFAULT_COMMAND, output=DEFAULT_OUTPUT):
+    # One job per terminus, length and allele batch. With more than one batch every batch
+    # gets its own directory inside the {LENGTH}-mer-test results directory.
+    jobs = []
+    batches = allele_batches(alleles, batch_size)
+    if isinstance(algorithms, str):
+        algorithms = re.split(r'[\s,]+', algorithms.strip())
+    algorithm_list = [algorithm for algorithm in algorithms if algorithm]
+
+    for terminus in termini:
+        for length in lengths:
+            input_fasta = os.path.join(working_dir, terminus, "pvacbind_inputs", f"{length}-mer-test.fa")
+            results_dir = os.path.join(working_dir, terminus, "pvacbind_results", f"{length}-mer-test")
+
+            for batch_number, batch in enumerate(batches):
+                output_dir = results_dir if len(batches) == 1 else os.path.join(results_dir, f"alleles-{batch_number + 1}")
+                fields = {'input_fasta': input_fasta, 'sample': sample, 'alleles': ','.join(batch),
+                          'algorithms': ' '.join(algorithm_list), 'output_dir': output_dir, 'length': length, 'terminus': terminus}
+
+                quoted = {field: shlex.quote(str(value)) for field, value in fields.items()}
+                # pvacbind takes the algorithms as separate arguments
+                quoted['algorithms'] = ' '.join(shlex.quote(algorithm) for algorithm in algorithm_list)
+
+                jobs.append({
+                    'name': f"{terminus}.{length}-mer" + ("" if len(batches) == 1 else f".alleles-{batch_number + 1}"),
+                    'command': command.format(**quoted),
+                    'output_dir': output_dir,
+                    'output': output.format(**fields),
+                })
+
+    return jobs
+
+def run_job(job, retries):
+    # Runs a job until it succeeds or the retries are used up, its output is logged to pvacbind.log
+    os.makedirs(job['output_dir'], exist_ok=True)
+    start = time.time()
+
+    for attempt in range(1, retries + 2):
+        with open(os.path.join(job['output_dir'], "pvacbind.log"), 'a') as log:
+            log.write(f"# attempt {attempt}: {job['command']}\n")
+            log.flush()
+            returncode = subprocess.run(job['command'], shell=True, stdout=log, stderr=subprocess.STDOUT).returncode
+
+        if returncode == 0:
+            status = 'done'
+            break
+        status = f"failed ({returncode})"
+
+    return {'name': job['name'], 'status': status, 'attempts': attempt, 'seconds': time.time() - start}
+
+def run_jobs(jobs, max_workers=None, retries=1):
+    # Runs the jobs in a bounded pool and returns one result per job in the order of jobs
+    results = {}
+    pending = []
+
+    for job in jobs:
+        if os.path.isfile(job['output']):
+            results[job['name']] = {'name': job['name'], 'status': 'skipped', 'attempts': 0, 'seconds': 0.0}
+            print("Skipping", job['name'], "output exists")
+        else:
+            pending.append(job)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_job, job, retries) for job in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result['name']] = result
+            print(f"{result['name']}: {result['status']} after {result['attempts']} attempt(s) in {result['seconds']:.1f}s")
+
+    return [results[job['name']] for job in jobs]
+
+def write_report(results, path):
+    with open(path, 'w') as report:
+        report.write("job\tstatus\tattempts\tseconds\n")
+        for result in results:
+            report.write(f"{result['name']}\t{result['status']}\t{result['attempts']}\t{result['seconds']:.3f}\n")
+
+def run_pvacbind(working_dir, sample, alleles, termini, lengths, algorithms='all_class_i', batch_size=0,
+                 max_workers=None, retries=1, command=DEFAULT_COMMAND, output=DEFAULT_OUTPUT):
+    # Plans and runs every job, returns False if any job failed
+    jobs = plan_jobs(working_dir, sample, alleles, termini, lengths, algorithms, batch_size, command, output)
+    results = run_jobs(jobs, max_workers, retries)
+    write_report(results, os.path.join(working_dir, "pvacbind_jobs.tsv"))
+
+    failed = [result['name'] for result in results if result['status'] not in ['done', 'skipped']]
+    if failed:
+        print("pVACbind failed for:", ', '.join(failed))
+    return not failed
+
+
+def main():
+    args = parse_arguments()
+
+    succeeded = run_pvacbind(args.WD, args.samp, args.HLA.split(','), args.termini.split(','),
+                             [int(length) for length in args.lengths.split(',')], args.algorithms, args.allele_batch,
+                             args.jobs, args.retries, args.command, args.output)
+    if not succeeded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+
+'''
+Reading the pVACseq aggregated and all_epitopes TSVs. Only the columns a script
+uses are parsed and gene, transcript and allele columns are read as categoricals,
+so a multi-million row all_epitopes.tsv fits in a fraction of the memory a full
+pd.read_csv needs. Scores keep their full precision, only the chunks streamed by
+iter_pvacseq_table and top_epitopes hold them as float32.
+
+Example:
+classI = read_pvacseq_table(args.classI, AGGREGATED_COLUMNS)
+for chunk in iter_pvacseq_table(args.classI, ALL_EPITOPES_COLUMNS, chunksize=500000):
+    ...
+'''
+
+# Columns used from the all_epitopes.aggregated.tsv
+AGGREGATED_COLUMNS = ['ID', 'Gene', 'AA Change', 'Best Transcript', 'Best Peptide',
+                      'Allele', 'Pos', 'IC50 MT', '%ile MT']
+
+# Columns used from the all_epitopes.tsv
+ALL_EPITOPES_COLUMNS = ['Index', 'Gene Name', 'Transcript', 'Mutation', 'Mutation Position',
+                        'MT Epitope Seq', 'HLA Allele', 'Median MT IC50 Score', 'Median MT Percentile']
+
+CATEGORICAL_COLUMNS = ['Gene', 'Gene Name', 'Best Transcript', 'Transcript', 'Allele', 'HLA Allele']
+
+SCORE_COLUMNS = ['IC50 MT', '%ile MT', 'IC50 WT', '%ile WT',
+                 'Median MT IC50 Score', 'Median MT Percentile', 'Median WT IC50 Score', 'Median WT Percentile']
+
+
+def column_dtypes(columns, text_dtype=None, score_dtype=np.float32):
+    # text_dtype is used for the remaining columns, None lets pandas infer them
+    dtypes = {column: text_dtype for column in columns if text_dtype is not None}
+    dtypes.update({column: 'category' for column in columns if column in CATEGORICAL_COLUMNS})
+    dtypes.update({column: score_dtype for column in columns if column in SCORE_COLUMNS})
+    return dtypes
+
+def read_pvacseq_table(path, columns, score_dtype=np.float64):
+    # Columns that are not in the file are skipped, the scripts fail on them as before.
+    # The scores end up in the review files, so they are read at full precision by default.
+    return pd.read_csv(path, sep="\t", usecols=lambda column: column in columns,
+                       dtype=column_dtypes(columns, score_dtype=score_dtype), low_memory=False)
+
+def iter_pvacseq_table(path, columns, chunksize=500000, score_dtype=np.float32):
+    # Yields the table in chunks of chunksize rows, every chunk has its own categories and float32 scores.
+    # The other columns are read as strings so they have the same type in every chunk.
+    reader = pd.read_csv(path, sep="\t", usecols=lambda column: column in columns,
+                         dtype=column_dtypes(columns, text_dtype=str, score_dtype=score_dtype), chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            yield chunk
+
+def infer_numeric_columns(df):
+    # Text columns that only hold numbers get a numeric type, as read_pvacseq_table would give them
+    for column in df.columns:
+        if column not in CATEGORICAL_COLUMNS and column not in SCORE_COLUMNS and pd.api.types.is_string_dtype(df[column]):
+            try:
+                df[column] = pd.to_numeric(df[column])
+            except (ValueError, TypeError):
+                pass
+    return df
+
+def as_text(column):
+    # Categorical column as plain strings (missing values stay NaN) so it can be concatenated
+    return column.astype(object)
+
+def widen_columns(df):
+    # Converts categoricals back to strings and float32 scores to float64 before a table is written.
+    # Scores are widened through their shortest decimal form, so 57.15 is written as 57.15
+    # and not as 57.150001525878906.
+    df = df.copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = as_text(df[column])
+        elif df[column].dtype == np.float32:
+            df[column] = df[column].to_numpy().astype(str).astype(np.float64)
+    return df
+
+def top_epitopes(path, columns, k, group_column='Index',
+                 rank_columns=('Median MT IC50 Score', 'Median MT Percentile'), chunksize=500000):
+    # Streams the table and keeps the k best rows (lowest IC50, then lowest percentile) of every group.
+    # At most k rows per group plus one chunk are held in memory, the scores are rounded to float32.
+    # Returns the kept rows in file order and the number of rows that were pruned.
+    kept = None
+    rows_read = 0
+
+    for chunk in iter_pvacseq_table(path, columns, chunksize):
+        chunk.index = pd.RangeIndex(rows_read, rows_read + len(chunk))
+        rows_read += len(chunk)
+
+        kept = chunk if kept is None else pd.concat([kept, chunk])
+        # Stable sort, rows that tie keep their order in the file
+        kept = kept.sort_values(list(rank_columns), kind='mergesort', na_position='last')
+        kept = kept.groupby(group_column, sort=False, dropna=False).head(k).sort_index()
+        # Chunks have their own categories, concat falls back to object columns
+        kept = kept.astype(column_dtypes(kept.columns))
+
+    if kept is None:
+        return read_pvacseq_table(path, columns, score_dtype=np.float32), 0
+
+    return infer_numeric_columns(kept.reset_index(drop=True)), rows_read - len(kept)
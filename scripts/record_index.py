@@ -0,0 +1,48 @@
+import numpy as np
+
+'''
+A keyed record layer over a DataFrame. The index from key to row positions is
+built once per table so every field of a row can be fetched without scanning
+the key column again.
+
+Example:
+records = RecordIndex(peptides_51mer, '51mer ID')
+record = records.record('ZP2.ENST00000574002.1.84D/Y')
+record['Best Peptide Class I']
+'''
+
+
+class RecordIndex:
+
+    def __init__(self, df, key_column):
+        self.key_column = key_column
+        self.columns = list(df.columns)
+        self.values = {column: df[column].to_numpy() for column in self.columns}
+
+        # Rows with a missing key can not be looked up, the same as df[key_column] == key
+        self.positions_by_key = df.groupby(key_column, sort=False).indices
+
+    def __len__(self):
+        return len(self.positions_by_key)
+
+    def __contains__(self, key):
+        return key in self.positions_by_key
+
+    def positions(self, key):
+        # All row positions for a key, in table order
+        return self.positions_by_key.get(key, np.arange(0))
+
+    def duplicated_keys(self):
+        return [key for key, positions in self.positions_by_key.items() if len(positions) > 1]
+
+    def record_at(self, position, columns=None):
+        if columns is None:
+            columns = self.columns
+        return {column: self.values[column][position] for column in columns}
+
+    def record(self, key, occurrence=0, columns=None):
+        # Returns the fields of the nth row with this key, or None if there is no such row
+        positions = self.positions(key)
+        if occurrence >= len(positions):
+            return None
+        return self.record_at(positions[occurrence], columns)
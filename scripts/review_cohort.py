@@ -0,0 +1,164 @@
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+import pandas as pd
+
+import setup_review
+
+'''
+Sets up the manual review files of every sample of a cohort. The sample sheet is
+a tsv with one row per sample and the columns
+
+    sample               name of the sample
+    WB                   the gcp_immuno folder of the sample (WORKING_BASE)
+    classI               classI all_epitopes.aggregated.tsv
+    classII              classII all_epitopes.aggregated.tsv
+    reviewed_candidates  ITB Reviewed Candidates tsv
+
+and optionally peptides (the 51mer manufacturability tsv, by default the one in
+generate_protein_fasta/candidates next to the working base), variants, yaml and
+fin_results. Empty optional cells are left out.
+
+Every sample runs the stages of setup_review.py (review files, coloring, FDA
+thresholds, neoantigen QC and HLA comparison) in its own worker process, -workers
+samples at a time. The output of a sample goes to its own log in -logs, a sample
+that fails does not stop the others and the status and wall time of every sample
+are written to the run summary. Stages a sample's manifest lists as up to date are
+not rerun (see setup_review.py).
+
+Example Run:
+python3 /opt/scripts/review_cohort.py -samples cohort.tsv -workers 8 -o cohort_summary.tsv
+'''
+
+REQUIRED_COLUMNS = ['sample', 'WB', 'classI', 'classII', 'reviewed_candidates']
+
+# The peptides of a sample when the sheet has none, relative to its working base
+DEFAULT_PEPTIDES = "{WB}/../generate_protein_fasta/candidates/annotated_filtered.vcf-pass-51mer.fa.manufacturability.tsv"
+
+
+# ---- PARSE ARGUMENTS -------------------------------------------------------
+# Parses command line arguments
+# Enables user help
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Set up the manual review files of every sample of a cohort')
+
+    parser.add_argument('-samples',
+                        help='The sample sheet tsv, one row per sample', required=True)
+    parser.add_argument('-workers', type=int, default=os.cpu_count(),
+                        help='The number of samples processed at the same time (default: number of CPUs)')
+    parser.add_argument('-stage_jobs', type=int, default=1,
+                        help='The number of stages of a sample run at the same time (default: 1)')
+    parser.add_argument('-force', action='store_true',
+                        help='Rerun every stage of every sample, even the ones the manifests list as up to date')
+    parser.add_argument('-logs', default='cohort_logs',
+                        help='The folder the log of every sample is written to (default: cohort_logs)')
+    parser.add_argument('-o', default='cohort_summary.tsv',
+                        help='The run summary tsv (default: cohort_summary.tsv)')
+
+    return(parser.parse_args())
+
+
+# ---- SAMPLE SHEET ----------------------------------------------------------
+def read_sample_sheet(path):
+    samples = pd.read_csv(path, sep="\t", dtype=str, keep_default_na=False)
+
+    missing = [column for column in REQUIRED_COLUMNS if column not in samples.columns]
+    if missing:
+        raise ValueError(f"Sample sheet {path} is missing the columns: {', '.join(missing)}")
+
+    repeated = samples['sample'][samples['sample'].duplicated()]
+    if not repeated.empty:
+        raise ValueError(f"Samples listed more than once in {path}: {', '.join(repeated.unique())}")
+
+    return samples.to_dict('records')
+
+def setup_review_argv(sample, stage_jobs, force=False):
+    # The setup_review.py arguments of one row of the sample sheet
+    argv = ['-WB', sample['WB'], '-samp', sample['sample'],
+            '-a', sample['reviewed_candidates'],
+            '-c', sample.get('peptides') or DEFAULT_PEPTIDES.format(WB=sample['WB']),
+            '-classI', sample['classI'], '-classII', sample['classII'],
+            '-jobs', str(stage_jobs)]
+    if force:
+        argv.append('-force')
+
+    for column, flag in [('variants', '-variants'), ('yaml', '-yaml'), ('fin_results', '-f')]:
+        if sample.get(column):
+            argv += [flag, sample[column]]
+    return argv
+
+
+# ---- RUN SAMPLES -----------------------------------------------------------
+def review_sample(sample, stage_jobs, log_path, force=False):
+    # Runs in a worker process. Everything the stages print goes to the log of the sample,
+    # an error is recorded in the summary instead of being raised.
+    start = time.time()
+    failed = []
+
+    with open(log_path, 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            timings = setup_review.setup_review(setup_review.parse_arguments(setup_review_argv(sample, stage_jobs, force)))
+            failed = [timing['name'] for timing in timings if timing['status'] not in setup_review.FINISHED]
+            status = 'failed' if failed else 'done'
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            status = 'error'
+
+    return {'sample': sample['sample'], 'status': status, 'seconds': time.time() - start,
+            'failed stages': ','.join(failed), 'log': log_path}
+
+def review_samples(samples, max_workers=None, stage_jobs=1, log_dir='cohort_logs', force=False):
+    # Returns one summary per sample in the order of the sample sheet
+    os.makedirs(log_dir, exist_ok=True)
+    summaries = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for sample in samples:
+            log_path = os.path.join(log_dir, f"{sample['sample']}.log")
+            futures[pool.submit(review_sample, sample, stage_jobs, log_path, force)] = (sample['sample'], log_path)
+
+        for future in as_completed(futures):
+            name, log_path = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                # the worker process itself died, e.g. it ran out of memory
+                summary = {'sample': name, 'status': 'error', 'seconds': float('nan'),
+                           'failed stages': '', 'log': log_path}
+                print(f"Warning: Sample {name} did not execute correctly. Error: {e!r}")
+
+            summaries[name] = summary
+            print(f"{name}: {summary['status']} in {summary['seconds']:.1f}s",
+                  f"(failed: {summary['failed stages']})" if summary['failed stages'] else "")
+
+    return [summaries[sample['sample']] for sample in samples]
+
+def write_summary(summaries, path):
+    summary = pd.DataFrame(summaries, columns=['sample', 'status', 'seconds', 'failed stages', 'log'])
+    summary.to_csv(path, sep="\t", index=False, float_format='%.3f')
+    return summary
+
+
+def main():
+    args = parse_arguments()
+
+    samples = read_sample_sheet(args.samples)
+    start = time.time()
+    summaries = review_samples(samples, args.workers, args.stage_jobs, args.logs, args.force)
+    summary = write_summary(summaries, args.o)
+
+    print()
+    print(f"{len(summary)} samples in {time.time() - start:.1f}s:",
+          ', '.join(f"{count} {status}" for status, count in summary['status'].value_counts().items()))
+
+    if (summary['status'] != 'done').any():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pandas as pd
+
+'''
+Reading and writing the review tables. Next to {samp}_Peptides_51-mer.xlsx a
+Feather (Arrow IPC) sidecar with the same table is written so the scripts that
+run afterwards do not have to read the workbook back with openpyxl.
+
+The sidecar is only used while it is at least as new as the workbook, so edits
+made to the xlsx by hand are never shadowed by a stale sidecar. pyarrow is
+optional, without it only the xlsx is written and read.
+
+The review workbooks are streamed to disk row by row with xlsxwriter in
+constant memory mode. Cells can be rich text, e.g. the colored 51mer sequence.
+Without xlsxwriter pandas' to_excel is used instead.
+'''
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# The header format pandas' to_excel uses
+HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+
+def sidecar_path(xlsx_path):
+    return os.path.splitext(xlsx_path)[0] + '.feather'
+
+def arrow_safe(df):
+    # Arrow needs one type per column, columns mixing e.g. numbers and strings are stored as strings
+    df = df.reset_index(drop=True)
+    for column in df.columns:
+        if df[column].dtype == object and pd.api.types.infer_dtype(df[column], skipna=True) not in ['string', 'boolean', 'empty']:
+            df[column] = df[column].map(lambda value: value if pd.isna(value) else str(value))
+    return df
+
+def write_sidecar(df, xlsx_path):
+    if feather is None:
+        print("pyarrow is not installed, no sidecar written for", xlsx_path)
+        return None
+
+    path = sidecar_path(xlsx_path)
+    # Uncompressed so the file can be memory mapped when it is read
+    feather.write_feather(pa.Table.from_pandas(arrow_safe(df), preserve_index=False), path, compression='uncompressed')
+    return path
+
+def read_peptides_table(xlsx_path):
+    # Reads the sidecar if there is an up to date one, otherwise the xlsx
+    path = sidecar_path(xlsx_path)
+
+    if feather is not None and os.path.isfile(path):
+        if not os.path.isfile(xlsx_path) or os.path.getmtime(path) >= os.path.getmtime(xlsx_path):
+            return feather.read_table(path, memory_map=True).to_pandas()
+        print("Sidecar", path, "is older than", xlsx_path, "reading the xlsx instead")
+
+    return pd.read_excel(xlsx_path)
+
+
+# ---- STREAMING WORKBOOK ----------------------------------------------------
+class RichText:
+    # A cell made of runs of text, each with its own xlsxwriter format properties (None for plain text)
+
+    def __init__(self, fragments):
+        self.fragments = [(properties, text) for properties, text in fragments if text != '']
+
+    def __str__(self):
+        return ''.join(text for properties, text in self.fragments)
+
+
+class StreamingWorkbook:
+    # Writes one sheet row by row, in constant memory mode only the current row is kept in memory
+
+    def __init__(self, path, columns, sheet_name='Sheet1'):
+        if xlsxwriter is None:
+            raise ImportError("xlsxwriter is needed to stream a workbook")
+
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'nan_inf_to_errors': True})
+        self.worksheet = self.workbook.add_worksheet(sheet_name)
+        self.formats = {}
+        self.row = 0
+
+        header_format = self.format(HEADER_FORMAT)
+        for column_number, column in enumerate(columns):
+            self.worksheet.write_string(0, column_number, str(column), header_format)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def format(self, properties):
+        # Formats are cached, xlsxwriter keeps every added format until the workbook is closed
+        key = tuple(sorted(properties.items()))
+        if key not in self.formats:
+            self.formats[key] = self.workbook.add_format(properties)
+        return self.formats[key]
+
+    def write_rich_text(self, column_number, cell):
+        if not any(properties for properties, text in cell.fragments):
+            self.worksheet.write_string(self.row, column_number, str(cell))
+        elif len(cell.fragments) == 1:
+            # A single formatted run is written as a formatted cell
+            properties, text = cell.fragments[0]
+            self.worksheet.write_string(self.row, column_number, text, self.format(properties))
+        else:
+            fragments = []
+            for properties, text in cell.fragments:
+                if properties:
+                    fragments.append(self.format(properties))
+                fragments.append(text)
+            self.worksheet.write_rich_string(self.row, column_number, *fragments)
+
+    def write_row(self, values):
+        self.row += 1
+        for column_number, value in enumerate(values):
+            if isinstance(value, RichText):
+                self.write_rich_text(column_number, value)
+            elif isinstance(value, str):
+                self.worksheet.write_string(self.row, column_number, value)
+            elif value is None or pd.isna(value):
+                continue
+            elif isinstance(value, (bool, np.bool_)):
+                self.worksheet.write_boolean(self.row, column_number, bool(value))
+            elif isinstance(value, (int, float, np.integer, np.floating)):
+                self.worksheet.write_number(self.row, column_number, value)
+            else:
+                self.worksheet.write(self.row, column_number, str(value))
+
+    def close(self):
+        self.workbook.close()
+
+
+def write_review_workbook(df, path):
+    # Writes the DataFrame like df.to_excel(path, index=False), streamed when xlsxwriter is installed
+    if xlsxwriter is None:
+        df.to_excel(path, index=False)
+        return
+
+    with StreamingWorkbook(path, df.columns) as workbook:
+        for values in df.itertuples(index=False, name=None):
+            workbook.write_row(values)
@@ -1,51 +1,301 @@
 import argparse
-import subprocess
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def execute_script(script_path):
+import generate_reviews_files
+import color_peptides51mer
+import get_FDA_thresholds
+import get_neoantigen_qc
+import hla_comparison
+import review_io
+import peptide_metrics
+import peptide_ids
+import epitope_locator
+import pvacseq_io
+import record_index
+
+'''
+Sets up the manual review files of a sample. Every stage is imported and run
+in-process, the Peptides 51-mer table is handed from generate_reviews_files to
+color_peptides51mer in memory instead of being read back from disk and the stages
+that do not depend on each other (review files, FDA thresholds, neoantigen QC and
+HLA comparison) run at the same time. A failed stage is reported and only the
+stages that depend on it are skipped. The wall time of every stage is written to
+setup_review_timings.tsv in the manual_review folder.
+
+The content hashes of the inputs, the arguments and the outputs of every stage are
+recorded in setup_review_manifest.json in the manual_review folder. A rerun skips
+the stages whose inputs and arguments are unchanged and whose outputs are still
+there, so e.g. new coloring thresholds only re-color the peptides and a new ITB
+review file reruns the review files and the coloring. -force reruns every stage.
+
+Example Run:
+python3 /opt/scripts/setup_review.py -WB $WORKING_BASE -samp $PATIENT_ID -a ../itb-review-files/*.tsv -c ../generate_protein_fasta/candidates/annotated_filtered.vcf-pass-51mer.fa.manufacturability.tsv -classI final_results/pVACseq/mhc_i/*.all_epitopes.aggregated.tsv -classII final_results/pVACseq/mhc_ii/*.all_epitopes.aggregated.tsv -yaml $WORKING_BASE/yamls/$CLOUD_YAML
+'''
+
+
+# ---- PARSE ARGUMENTS -------------------------------------------------------
+# Parses command line arguments
+# Enables user help
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Sets up manuel review files')
+
+    parser.add_argument('-WB',
+                        help='the path to the gcp_immuno folder of the trial you wish to tun script on, defined as WORKING_BASE in envs.txt', required=True)
+    parser.add_argument('-samp', help='Name of the sample', required=True)
+    parser.add_argument('-a', help='Path to ITB Reviewed Candidates', required=True)
+    parser.add_argument('-c', help='Path to annotated_filtered.vcf-pass-51mer.fa.manufacturability.tsv', required=True)
+    parser.add_argument('-classI', help='Path to classI all_epitopes.aggregated.tsv', required=True)
+    parser.add_argument('-classII', help='Path to classII all_epitopes.aggregated.tsv', required=True)
+    parser.add_argument('-variants', help='Path to variants.final.annotated.tsv, fills the Variant Called by CLE Pipeline column')
+    parser.add_argument('-f', '--fin_results', default='final_results', help='Name of the final results folder in gcp immuno (default: final_results)')
+    parser.add_argument('-yaml', help='Path to the pipeline YAML file, the neoantigen QC is skipped without it')
+    parser.add_argument('-cIIC50', help='Maximum classI IC50 score to color (default: see color_peptides51mer.py)')
+    parser.add_argument('-cIpercent', help='Maximum classI percentile to color (default: see color_peptides51mer.py)')
+    parser.add_argument('-cIIIC50', help='Maximum classII IC50 score to color (default: see color_peptides51mer.py)')
+    parser.add_argument('-cIIpercent', help='Maximum classII percentile to color (default: see color_peptides51mer.py)')
+    parser.add_argument('-probPos', nargs='*', help='problematic position to make large')
+    parser.add_argument('-jobs', type=int, default=4,
+                        help='The number of stages to run at the same time (default: 4)')
+    parser.add_argument('-force', action='store_true',
+                        help='Rerun every stage, even the ones the manifest lists as up to date')
+
+    return(parser.parse_args(argv))
+
+
+# ---- STAGES ----------------------------------------------------------------
+# A stage is a function of the results of the stages listed in 'after'. Its inputs, params and
+# outputs are what the manifest records, the script and the helper modules it imports are inputs too.
+# The arguments of every stage are parsed up front so a bad argument fails before anything runs.
+REVIEW_MODULES = [generate_reviews_files, review_io, peptide_metrics, peptide_ids, epitope_locator, pvacseq_io]
+COLOR_MODULES = [color_peptides51mer, review_io, record_index, epitope_locator]
+
+def module_files(modules):
+    return [module.__file__ for module in modules]
+
+def review_stages(args):
+    manual_review = f"{args.WB}/../manual_review"
+    final_results = f"{args.WB}/{args.fin_results}"
+    peptides_file = f"{manual_review}/{args.samp}_Peptides_51-mer.xlsx"
+
+    review_argv = ['-reviewed_candidates', args.a, '-peptides', args.c, '-classI', args.classI, '-classII', args.classII,
+                   '-samp', args.samp, '-o', manual_review]
+    if args.variants:
+        review_argv += ['-variants', args.variants]
+    review_args = generate_reviews_files.parse_arguments(review_argv)
+
+    color_argv = ['-peptides', peptides_file, '-classI', args.classI, '-classII', args.classII,
+                  '-samp', args.samp, '-o', manual_review + '/']
+    for flag in ['cIIC50', 'cIpercent', 'cIIIC50', 'cIIpercent']:
+        if getattr(args, flag) is not None:
+            color_argv += ['-' + flag, getattr(args, flag)]
+    if args.probPos is not None:
+        color_argv += ['-probPos'] + args.probPos
+    color_args = color_peptides51mer.parse_arguments(color_argv)
+
+    fda_argv = ['-WB', args.WB, '-f', args.fin_results]
+    fda_args = get_FDA_thresholds.parse_arguments(fda_argv)
+    hla_argv = ['-WB', args.WB, '-f', args.fin_results, '--o', manual_review]
+    hla_args = hla_comparison.parse_arguments(hla_argv)
+
+    stages = [
+        {'name': 'review_files', 'after': [],
+         # the review files are always rebuilt from the inputs, so only the written files are its outputs
+         'inputs': module_files(REVIEW_MODULES) + [args.a, args.c, args.classI, args.classII] + ([args.variants] if args.variants else []),
+         'params': review_argv,
+         'outputs': [peptides_file, review_io.sidecar_path(peptides_file), f"{manual_review}/{args.samp}.Annotated.Neoantigen_Candidates.xlsx"],
+         'run': lambda results: generate_reviews_files.main(review_args)},
+        {'name': 'color_peptides', 'after': ['review_files'],
+         # without the table in memory (review_files was up to date) it is read back from the sidecar
+         'inputs': module_files(COLOR_MODULES) + [peptides_file, review_io.sidecar_path(peptides_file), args.classI, args.classII],
+         'params': color_argv,
+         'outputs': [f"{manual_review}/{args.samp}.Colored_Peptides.html"],
+         'run': lambda results: color_peptides51mer.main(color_args, results.get('review_files'))},
+        {'name': 'fda_thresholds', 'after': [],
+         'inputs': [get_FDA_thresholds.__file__, f"{final_results}/qc"],
+         'params': fda_argv,
+         'outputs': [f"{manual_review}/fda_quality_thresholds_report.tsv"],
+         'run': lambda results: get_FDA_thresholds.main(fda_args)},
+        {'name': 'hla_comparison', 'after': [],
+         'inputs': [hla_comparison.__file__, f"{final_results}/hla_typing"],
+         'params': hla_argv,
+         'outputs': [f"{manual_review}/hla_comparison.tsv"],
+         'run': lambda results: hla_comparison.main(hla_args)},
+    ]
+
+    if args.yaml:
+        qc_argv = ['-WB', args.WB, '-f', args.fin_results, '--yaml', args.yaml]
+        qc_args = get_neoantigen_qc.parse_arguments(qc_argv)
+        stages.append({'name': 'neoantigen_qc', 'after': [],
+                       'inputs': [get_neoantigen_qc.__file__, f"{final_results}/qc", f"{final_results}/variants.final.annotated.tsv", args.yaml],
+                       'params': qc_argv,
+                       'outputs': [f"{manual_review}/qc_file.txt"],
+                       'run': lambda results: get_neoantigen_qc.main(qc_args)})
+    else:
+        print("No -yaml given, skipping the neoantigen QC")
+
+    return stages
+
+
+# ---- MANIFEST --------------------------------------------------------------
+def content_hash(path):
+    # sha256 of a file, of every file below a folder together with its relative path, None if the path is missing
+    if not os.path.exists(path):
+        return None
+
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode())
+                digest.update(content_hash(file_path).encode())
+    else:
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def content_hashes(paths):
+    return {os.path.normpath(os.path.abspath(path)): content_hash(path) for path in paths}
+
+def stage_record(stage):
+    # What a stage was run with, the output hashes are added once it is done
+    return {'inputs': content_hashes(stage['inputs']), 'params': stage['params']}
+
+def up_to_date(record, previous):
+    # Up to date when the inputs and params did not change and the outputs are the ones the last run wrote
+    if previous is None or previous['inputs'] != record['inputs'] or previous['params'] != record['params']:
+        return False
+    return content_hashes(previous['outputs']) == previous['outputs']
+
+def read_manifest(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as manifest:
+        return json.load(manifest)
+
+def write_manifest(manifest, path):
+    # Written to a temporary file first so an interrupted run never leaves half a manifest
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+# ---- RUN STAGES ------------------------------------------------------------
+# A stage that was skipped because its manifest record is unchanged counts as finished
+FINISHED = ['done', 'up to date']
+
+def run_stage(stage, results, start, manifest=None):
+    started = time.time()
+    result = None
     try:
-        print("Executing...", script_path)
-        subprocess.run(script_path, shell=True, check=True)
-        print("Successful.")
-        print()
-    except subprocess.CalledProcessError as e:
-        print(f"Warning: Script {script_path} did not execute correctly. Error: {e}")
-        print()
+        if manifest is not None:
+            # the inputs are hashed once the stages the stage depends on are done, so their new outputs are seen
+            record = stage_record(stage)
+            if up_to_date(record, manifest.get(stage['name'])):
+                print("Up to date.", stage['name'])
+                return {'name': stage['name'], 'status': 'up to date', 'started': started - start,
+                        'seconds': time.time() - started}, result
+            manifest.pop(stage['name'], None)
 
+        print("Executing...", stage['name'])
+        result = stage['run'](results)
+        status = 'done'
+        print("Successful.", stage['name'])
 
-# Define the command-line arguments
-parser = argparse.ArgumentParser(description='Sets up manuel review files')
+        if manifest is not None:
+            record['outputs'] = content_hashes(stage['outputs'])
+            manifest[stage['name']] = record
+    except (Exception, SystemExit) as e:
+        # argparse and the scripts exit through SystemExit, it must not end the other stages
+        print(f"Warning: Stage {stage['name']} did not execute correctly. Error: {e!r}")
+        traceback.print_exc()
+        result = None
+        status = 'failed'
 
-parser.add_argument('-WB',
-                    help='the path to the gcp_immuno folder of the trial you wish to tun script on, defined as WORKING_BASE in envs.txt')
+    return {'name': stage['name'], 'status': status, 'started': started - start,
+            'seconds': time.time() - started}, result
 
-parser.add_argument('-samp', help='Name of the sample')
-parser.add_argument('-a', help='Path to ITB Reviewed Candidates')
-parser.add_argument('-c', help='Path to annotated_filtered.vcf-pass-51mer.fa.manufacturability.tsv')
+def run_stages(stages, max_workers=None, manifest=None):
+    # Runs every stage once the stages it depends on are done, at most max_workers at a time.
+    # With a manifest (a dict of stage records) stages that are up to date are not run and the
+    # records of the stages that ran are updated in it.
+    # Returns one timing per stage in the order of stages and the result of every stage that ran.
+    results = {}
+    timings = {}
+    waiting = list(stages)
+    running = {}
+    start = time.time()
 
-parser.add_argument('-classI', help='Path to classI all_epitopes.aggregated.tsv', required=True)
-parser.add_argument('-classII', help='Path to classII all_epitopes.aggregated.tsv', required=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while waiting or running:
+            scheduled = False
+            for stage in list(waiting):
+                statuses = [timings[name]['status'] if name in timings else None for name in stage['after']]
+                if any(status not in [None] + FINISHED for status in statuses):
+                    waiting.remove(stage)
+                    timings[stage['name']] = {'name': stage['name'], 'status': 'skipped', 'started': time.time() - start, 'seconds': 0.0}
+                    print("Skipping", stage['name'], "a stage it depends on did not finish")
+                    scheduled = True
+                elif None not in statuses:
+                    waiting.remove(stage)
+                    running[pool.submit(run_stage, stage, results, start, manifest)] = stage
+                    scheduled = True
 
+            if not running:
+                # the stages left wait for a stage that was skipped in this pass, or for one that never runs
+                if not scheduled:
+                    raise ValueError("Stages wait for unknown stages or each other: " + ', '.join(stage['name'] for stage in waiting))
+                continue
 
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                timing, result = future.result()
+                timings[stage['name']] = timing
+                if timing['status'] == 'done':
+                    results[stage['name']] = result
 
-# Parse the command-line arguments
-args = parser.parse_args()
+    return [timings[stage['name']] for stage in stages], results
 
-# Check if the required arguments are provided
-if not args.classI or not args.classII or not args.WB:
-    parser.error("Missing required arguments. Please provide -p, -classI, -classII, and -WB.")
+def write_timings(timings, path):
+    with open(path, 'w') as report:
+        report.write("stage\tstatus\tstarted\tseconds\n")
+        for timing in timings:
+            report.write(f"{timing['name']}\t{timing['status']}\t{timing['started']:.3f}\t{timing['seconds']:.3f}\n")
 
 
+def setup_review(args):
+    # Runs every stage of one sample and returns the timings, also used by review_cohort.py
+    manual_review = f"{args.WB}/../manual_review"
+    os.makedirs(manual_review, exist_ok=True)
 
-command1 = f"python /opt/scripts/generate_reviews_files.py -WB {args.WB} -a {args.a} -c {args.c} -samp {args.samp}"
-command2 = f"python /opt/scripts/color_peptides51mer.py -WB {args.WB} -p {args.WB}/../manual_review/{args.samp}_Peptides_51-mer.xlsx -classI {args.classI} -classII {args.classII} -samp {args.samp}"
+    manifest_path = f"{manual_review}/setup_review_manifest.json"
+    manifest = {} if args.force else read_manifest(manifest_path)
 
+    timings, _ = run_stages(review_stages(args), args.jobs, manifest)
+    write_manifest(manifest, manifest_path)
+    write_timings(timings, f"{manual_review}/setup_review_timings.tsv")
+    return timings
 
-# Execute the first script
-execute_script(command1)
 
-# Execute the second script
-execute_script(command2)
+def main():
+    args = parse_arguments()
 
+    timings = setup_review(args)
+    for timing in timings:
+        print(f"{timing['name']}: {timing['status']} in {timing['seconds']:.1f}s")
 
+    if any(timing['status'] not in FINISHED for timing in timings):
+        sys.exit(1)
 
 
+if __name__ == "__main__":
+    main()